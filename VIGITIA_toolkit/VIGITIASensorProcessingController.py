@@ -5,12 +5,18 @@ import os
 import sys
 import time
 import ctypes
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 
 from VIGITIA_toolkit.data_transportation.VIGITIAVideoStreamer import VIGITIAVideoStreamer
 from VIGITIA_toolkit.sensors.cameras.realsense_D435_camera import RealsenseD435Camera
 from VIGITIA_toolkit.sensors.cameras.GenericWebcam import GenericWebcam
+from VIGITIA_toolkit.sensors.cameras.ReplayCamera import ReplayCamera
+from VIGITIA_toolkit.core.VIGITIACameraRecorder import VIGITIACameraRecorder
 
 from VIGITIA_toolkit.data_transportation.TUIOServer import TUIOServer  # Import TUIO Server
 
@@ -25,9 +31,9 @@ from VIGITIA_toolkit.sensor_processing_services.TouchDetectionService import Tou
 from VIGITIA_toolkit.sensor_processing_services.ObjectDetectionService import ObjectDetectionService
 from VIGITIA_toolkit.sensor_processing_services.HandLandmarkDetectionService import HandLandmarkDetectionService
 
-# TODO: Allow multiple
-TARGET_COMPUTER_IP = '10.61.3.117' #get_ip_address()
-print(TARGET_COMPUTER_IP)
+# All target computers receive the same TUIO bundles. Multicast group addresses (e.g. '239.0.0.1') are supported too
+TARGET_COMPUTER_IPS = ['10.61.3.117']  # [get_ip_address()]
+print(TARGET_COMPUTER_IPS)
 
 TARGET_COMPUTER_PORT = 3333 #8000
 
@@ -39,6 +45,81 @@ ENABLE_MARKER_DETECTOR = True
 ENABLE_OBJECT_DETECTOR = False
 ENABLE_TOUCH_DETECTOR = True
 
+# Record the camera frames to this directory while processing them (None: no recording)
+RECORDING_DIRECTORY = None
+# Use a recording of the VIGITIACameraRecorder instead of the camera, e.g. for reproducible benchmarks (None: camera)
+REPLAY_DIRECTORY = None
+
+FRAME_TIMEOUT = 0.1  # Maximum time in seconds to wait for a new camera frame before checking for user input again
+
+# Run each processing step in its own thread, connected by queues of the given size
+PIPELINED_MODE = False
+PIPELINE_QUEUE_SIZE = 2
+
+# Run the independent sensor processing services (markers, objects, touch) in parallel for each frame
+PARALLEL_SERVICES = True
+
+
+class PipelineStage:
+    """ A single step of the processing pipeline of the VIGITIASensorProcessingController
+
+        Takes frames from the input queue, passes them to the given function and puts the result into the output queue.
+        Stages without an input queue act as a source and call the function repeatedly. If the function raises an
+        exception, the stage stops and sets failed to True, so that the whole pipeline can be shut down.
+
+    """
+
+    def __init__(self, name, function, input_queue=None, output_queue=None):
+        self.name = name
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+
+        self.started = False
+        self.failed = False
+        self.thread = None
+
+    def start(self):
+        self.started = True
+        self.thread = threading.Thread(target=self.update, args=(), name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self):
+        try:
+            self.process_frames()
+        except Exception:
+            print('[PipelineStage]: Error in stage "{}". Stopping the pipeline'.format(self.name), file=sys.stderr)
+            traceback.print_exc()
+            self.failed = True
+            self.started = False
+
+    def process_frames(self):
+        while self.started:
+            if self.input_queue is None:
+                frame = self.function()
+                if frame is None:
+                    continue
+            else:
+                try:
+                    frame = self.input_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                frame = self.function(frame)
+
+            if self.output_queue is not None and frame is not None:
+                # Block until the next stage is ready. This limits the number of frames in flight.
+                while self.started:
+                    try:
+                        self.output_queue.put(frame, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+
+    def stop(self):
+        self.started = False
+        self.thread.join()
+
 
 class VIGITIASensorProcessingController:
     """ VIGITIASensorProcessingController
@@ -47,32 +128,53 @@ class VIGITIASensorProcessingController:
     """
 
     frame_id = 0
+    last_sequence_number = 0  # Sequence number of the last camera frame that has been processed
+
+    # Debug images of the last frame that has been sent. OpenCV windows may only be used in the main thread, so the
+    # processing steps only collect their debug images in the frame (see show_debug_images())
+    debug_images = {}
+    shown_debug_images = None
 
-    hand_regions = []
-    detected_hands = []
+    fps_counter = 0
+    fps_start_time = 0
 
     def __init__(self):
         self.init_cameras()
+        self.init_sensor_data_processing_services()
         self.init_tuio_server()
         # self.init_video_streamers()
-        self.init_sensor_data_processing_services()
 
         self.loop()
 
+        # Write the remaining recorded frames to disk
+        if self.camera_recorder is not None:
+            self.camera_recorder.stop()
+
     def init_cameras(self):
         # TODO: Select camera via GUI
         #self.camera = GenericWebcam()
-        self.camera = RealsenseD435Camera()
+        if REPLAY_DIRECTORY is not None:
+            self.camera = ReplayCamera(REPLAY_DIRECTORY)
+        else:
+            self.camera = RealsenseD435Camera()
         self.camera.init_video_capture()
         self.camera.start()
 
+        self.camera_recorder = None
+        if RECORDING_DIRECTORY is not None:
+            self.camera_recorder = VIGITIACameraRecorder(self.camera, RECORDING_DIRECTORY)
+            self.camera_recorder.start()
+
     def init_tuio_server(self):
-        self.tuio_server = TUIOServer(TARGET_COMPUTER_IP, TARGET_COMPUTER_PORT)
+        self.tuio_server = TUIOServer(TARGET_COMPUTER_IPS, TARGET_COMPUTER_PORT)
 
         camera_res_x, camera_res_y = self.camera.get_resolution()
         print(camera_res_x, camera_res_y)
 
-        self.dimension = self.get_dimension(camera_res_x, camera_res_y)
+        # All coordinates sent via TUIO refer to the extracted table area
+        res_x, res_y = self.table_surface_extractor.get_output_resolution(camera_res_x, camera_res_y)
+
+        self.dimension = self.get_dimension(res_x, res_y)
         self.source = os.uname()[1]  # TODO: Not working on windows
 
     def get_dimension(self, res_x, res_y):
@@ -94,7 +196,8 @@ class VIGITIASensorProcessingController:
 
     def init_video_streamers(self):
         # TODO: Let user select in GUI what video should be streamed
-        self.video_streamer = VIGITIAVideoStreamer(TARGET_COMPUTER_IP, 5000)
+        # TODO: Stream to all target computers
+        self.video_streamer = VIGITIAVideoStreamer(TARGET_COMPUTER_IPS[0], 5000)
 
     # Init all Sensor Processing Services here
     def init_sensor_data_processing_services(self):
@@ -102,60 +205,39 @@ class VIGITIASensorProcessingController:
         self.fiducials_detector = FiducialsDetectionService()
         #self.movement_detector = MovementDetector()
         self.foreground_mask_extractor = ForegroundMaskExtractor()
-        self.touch_detector = TouchDetectionService()
+        self.touch_detector = TouchDetectionService(image_flipped=FLIP_IMAGE)
         #self.table_detector = TableDetector()
         self.generic_object_detector = ObjectDetectionService()
         self.hand_tracker = HandLandmarkDetectionService()
 
+        self.service_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='SensorProcessingService')
+
     # The main application loop. Code parts for fps counter from
     # https://stackoverflow.com/questions/43761004/fps-how-to-divide-count-by-time-function-to-determine-fps
     def loop(self):
-        # Variables for fps counter
-        start_time = 0
-        counter = 0
+        if PIPELINED_MODE:
+            self.run_pipeline()
+            return
 
         while True:
             # Get frames from cameras
-            color_image, depth_image = self.camera.get_frames()
+            frame = self.capture_frame()
 
             # Only continue if needed frames are available
-            if color_image is not None:
-                self.frame_id += 1
-
+            if frame is not None:
                 # Pre-process camera frames
-                color_image_table = self.table_surface_extractor.extract_table_area(color_image)
-                if depth_image is not None:
-                    depth_image_table = self.table_surface_extractor.extract_table_area(depth_image)
-                else:
-                    depth_image_table = None
-
-                if FLIP_IMAGE:
-                    color_image_table = cv2.flip(color_image_table, -1)
-                    # TODO: Flip depth image
-
-                if DEBUG_MODE:
-                    # Preview frames
-                    cv2.imshow('color_image_table', color_image_table)
-
-                # Start a new TUIO Bundle for the current frame
-                self.tuio_server.start_tuio_bundle(dimension=self.dimension, source=self.source)
+                self.preprocess_frame(frame)
 
                 # Stream Frames
                 # self.stream_frames(color_image, color_image_table, depth_image)
 
-                # Run Sensor Processing Services. They all add their data to the TUIO Bundle
-                self.run_sensor_processing_services(color_image, color_image_table, depth_image, depth_image_table)
+                # Run Sensor Processing Services. They all add their results to the frame
+                self.run_sensor_processing_services(frame)
 
-                # Send the TUIO Bundle
-                self.tuio_server.send_tuio_bundle()
+                # Convert the results to TUIO messages and send the TUIO Bundle
+                self.send_frame(frame)
 
-                # FPS Counter
-                counter += 1
-                if (time.time() - start_time) > 1:  # displays the frame rate every 1 second
-                    if DEBUG_MODE:
-                        print("[SensorProcessingController]: FPS: ", round(counter / (time.time() - start_time), 1))
-                    counter = 0
-                    start_time = time.time()
+            self.show_debug_images()
 
             key = cv2.waitKey(1)
             # Press esc or 'q' to close the image window
@@ -163,19 +245,225 @@ class VIGITIASensorProcessingController:
                 cv2.destroyAllWindows()
                 break
 
-    # Call all selected sensor processing services for the current frame
-    def run_sensor_processing_services(self, color_image, color_image_table, depth_image, depth_image_table):
+    # Run each processing step in its own worker thread. The workers are connected by bounded queues, so while a later
+    # stage is still working on frame N, the earlier stages can already work on frame N+1. Each stage processes the
+    # frames strictly in the order they arrive, so the TUIO bundles are sent out in order.
+    def run_pipeline(self):
+        stage_functions = [self.preprocess_frame, self.add_foreground_mask]
+        if ENABLE_MARKER_DETECTOR:
+            stage_functions.append(self.add_aruco_markers)
+        if ENABLE_OBJECT_DETECTOR:
+            stage_functions.append(self.add_detected_objects)
+        if ENABLE_TOUCH_DETECTOR:
+            stage_functions.append(self.add_detected_hands)
+            stage_functions.append(self.add_touch_points)
+        stage_functions.append(self.send_frame)
+
+        stages = [PipelineStage('capture', self.capture_frame, output_queue=queue.Queue(maxsize=PIPELINE_QUEUE_SIZE))]
+        for i, stage_function in enumerate(stage_functions):
+            is_last_stage = i == len(stage_functions) - 1
+            output_queue = None if is_last_stage else queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            stages.append(PipelineStage(stage_function.__name__, stage_function, stages[-1].output_queue,
+                                        output_queue))
+
+        for stage in stages:
+            stage.start()
+
+        print('[SensorProcessingController]: Running pipeline with stages:', [stage.name for stage in stages])
+
+        # The main thread only handles the OpenCV windows
+        while True:
+            if any(stage.failed for stage in stages):
+                break
+
+            self.show_debug_images()
+
+            key = cv2.waitKey(1)
+            # Press esc or 'q' to close the image window
+            if key & 0xFF == ord('q') or key == 27:
+                cv2.destroyAllWindows()
+                break
+            time.sleep(0.001)
+
+        for stage in stages:
+            stage.stop()
+
+    # Wait for the next frame of the camera. Returns None if no new frame is available yet
+    def capture_frame(self):
+        # Block until the camera has a new frame instead of processing the same frame multiple times
+        if self.camera.wait_for_next_frame(FRAME_TIMEOUT, self.last_sequence_number) is None:
+            return None
+
+        sequence_number, color_image, depth_image = self.camera.borrow_frames()
+        if color_image is None or sequence_number == self.last_sequence_number:
+            self.camera.release_frames(sequence_number)
+            return None
+
+        self.last_sequence_number = sequence_number
+
+        self.frame_id += 1
+        return self.create_frame(self.frame_id, sequence_number, color_image, depth_image)
+
+    # All data belonging to a single camera frame is collected in a dict that is passed through the processing steps
+    @staticmethod
+    def create_frame(frame_id, sequence_number, color_image, depth_image):
+        return {
+            'frame_id': frame_id,
+            'sequence_number': sequence_number,  # Sequence number of the camera frames
+            'color_image': color_image,
+            'depth_image': depth_image,
+            'color_image_table': None,
+            'depth_image_table': None,
+            'foreground_mask': None,
+            'aruco_markers': [],
+            'detected_objects': [],
+            'detected_hands': [],
+            'hand_regions': [],
+            'touch_points': [],
+            'debug_images': {}  # Window name -> image to show in DEBUG_MODE
+        }
+
+    def preprocess_frame(self, frame):
+        color_image_table = self.table_surface_extractor.extract_table_area(frame['color_image'])
+        if frame['depth_image'] is not None:
+            # Do not interpolate between the measured distances of neighbouring pixels
+            depth_image_table = self.table_surface_extractor.extract_table_area(frame['depth_image'],
+                                                                                 cv2.INTER_NEAREST)
+        else:
+            depth_image_table = None
+
+        if FLIP_IMAGE:
+            color_image_table = cv2.flip(color_image_table, -1)
+            # The depth image needs to be flipped as well, otherwise it does not line up with the masks and touch points
+            # found in the color image
+            if depth_image_table is not None:
+                depth_image_table = cv2.flip(depth_image_table, -1)
 
-        foreground_mask = self.get_foreground_mask(color_image_table)
         if DEBUG_MODE:
-            cv2.imshow('Binary Mask of the foreground', foreground_mask)
+            # Preview frames
+            frame['debug_images']['color_image_table'] = color_image_table
+
+        frame['color_image_table'] = color_image_table
+        frame['depth_image_table'] = depth_image_table
+
+        # The camera frames are only borrowed. From now on only the extracted table area is needed
+        self.camera.release_frames(frame['sequence_number'])
+        frame['color_image'] = None
+        frame['depth_image'] = None
+
+        return frame
+
+    # Call all selected sensor processing services for the current frame
+    def run_sensor_processing_services(self, frame):
+        # The foreground mask is needed by all other services, so it needs to be ready first
+        self.add_foreground_mask(frame)
 
+        services = []
         if ENABLE_MARKER_DETECTOR:
-            self.get_aruco_markers(color_image_table, foreground_mask)
+            services.append(self.add_aruco_markers)
         if ENABLE_OBJECT_DETECTOR:
-            self.get_detected_objects(color_image_table.copy(), foreground_mask)
+            services.append(self.add_detected_objects)
         if ENABLE_TOUCH_DETECTOR:
-            self.get_touch_points(color_image_table, depth_image_table, foreground_mask)
+            services.append(self.add_hands_and_touch_points)
+
+        if PARALLEL_SERVICES and len(services) > 1:
+            # The services are independent of each other and each writes only its own results into the frame.
+            # OpenCV and TFLite release the GIL, so running them in threads reduces the latency to the slowest service.
+            futures = [self.service_executor.submit(service, frame) for service in services]
+
+            # Wait until all services are finished before the frame is sent. result() also re-raises any exceptions
+            for future in futures:
+                future.result()
+        else:
+            for service in services:
+                service(frame)
+
+        return frame
+
+    def add_foreground_mask(self, frame):
+        frame['foreground_mask'] = self.get_foreground_mask(frame['color_image_table'])
+        if DEBUG_MODE:
+            frame['debug_images']['Binary Mask of the foreground'] = frame['foreground_mask']
+        return frame
+
+    def add_aruco_markers(self, frame):
+        frame['aruco_markers'] = self.get_aruco_markers(frame['color_image_table'], frame['foreground_mask'])
+        frame['debug_images'].update(self.fiducials_detector.debug_images)
+        return frame
+
+    def add_detected_objects(self, frame):
+        frame['detected_objects'] = self.get_detected_objects(frame['color_image_table'].copy(),
+                                                              frame['foreground_mask'])
+        frame['debug_images'].update(self.generic_object_detector.debug_images)
+        return frame
+
+    def add_detected_hands(self, frame):
+        frame['detected_hands'], frame['hand_regions'] = self.get_detected_hands(frame['color_image_table'],
+                                                                                 frame['debug_images'])
+        return frame
+
+    def add_hands_and_touch_points(self, frame):
+        color_image_table = frame['color_image_table']
+        if PARALLEL_SERVICES:
+            # The TouchDetectionService draws its debug output onto the color image, which the other services read
+            color_image_table = color_image_table.copy()
+
+        frame['detected_hands'], frame['hand_regions'] = self.get_detected_hands(color_image_table,
+                                                                                 frame['debug_images'])
+        frame['touch_points'] = self.get_touch_points(color_image_table, frame['depth_image_table'],
+                                                      frame['foreground_mask'], frame['detected_hands'],
+                                                      frame['hand_regions'])
+        frame['debug_images'].update(self.touch_detector.debug_images)
+        return frame
+
+    def add_touch_points(self, frame):
+        frame['touch_points'] = self.get_touch_points(frame['color_image_table'], frame['depth_image_table'],
+                                                      frame['foreground_mask'], frame['detected_hands'],
+                                                      frame['hand_regions'])
+        frame['debug_images'].update(self.touch_detector.debug_images)
+        return frame
+
+    # Convert the results of all sensor processing services for the given frame into TUIO messages and send them
+    def send_frame(self, frame):
+        # Start a new TUIO Bundle for the current frame
+        self.tuio_server.start_tuio_bundle(dimension=self.dimension, source=self.source)
+
+        self.add_aruco_marker_messages(frame['aruco_markers'])
+        self.add_detected_object_messages(frame['detected_objects'])
+        self.add_touch_point_messages(frame['touch_points'])
+
+        # Send the TUIO Bundle
+        self.tuio_server.send_tuio_bundle()
+
+        # Hand the debug images over to the main thread
+        self.debug_images = frame['debug_images']
+
+        self.update_fps_counter()
+
+        return frame
+
+    # Show the debug images of the last sent frame. Needs to be called from the main thread
+    def show_debug_images(self):
+        if not DEBUG_MODE:
+            return
+
+        # Each frame brings a new dict. Only show the images once
+        debug_images = self.debug_images
+        if debug_images is self.shown_debug_images:
+            return
+        self.shown_debug_images = debug_images
+
+        for window_name, image in debug_images.items():
+            cv2.imshow(window_name, image)
+
+    def update_fps_counter(self):
+        self.fps_counter += 1
+        if (time.time() - self.fps_start_time) > 1:  # displays the frame rate every 1 second
+            if DEBUG_MODE:
+                print("[SensorProcessingController]: FPS: ",
+                      round(self.fps_counter / (time.time() - self.fps_start_time), 1))
+            self.fps_counter = 0
+            self.fps_start_time = time.time()
 
     # This function handles the streaming of all video frames
     def stream_frames(self, color_image, color_image_table, depth_image):
@@ -191,10 +479,12 @@ class VIGITIASensorProcessingController:
     def get_foreground_mask(self, color_image_table):
         return self.foreground_mask_extractor.get_foreground_mask_otsu(color_image_table)
 
-    # Get data from the GenericObjectDetectionService and convert it to TUIO messages
+    # Get data from the GenericObjectDetectionService
     def get_detected_objects(self, color_image_table, foreground_mask):
-        detected_objects = self.generic_object_detector.detect_generic_objects(color_image_table, foreground_mask)
+        return self.generic_object_detector.detect_generic_objects(color_image_table, foreground_mask)
 
+    # Convert the detected objects to TUIO messages
+    def add_detected_object_messages(self, detected_objects):
         # Give each object an ID
         for detected_object in detected_objects:
             if detected_object['label'] == 'orange':
@@ -224,12 +514,10 @@ class VIGITIASensorProcessingController:
                                                       height=detected_object['height'], area=0)
 
     def get_aruco_markers(self, color_image_table,  foreground_mask):
-        aruco_markers = self.fiducials_detector.detect_fiducials(color_image_table, foreground_mask)
+        return self.fiducials_detector.detect_fiducials(color_image_table, foreground_mask)
 
+    def add_aruco_marker_messages(self, aruco_markers):
         for marker in aruco_markers:
-
-            print(marker['id'])
-
             self.tuio_server.add_symbol_message(s_id=int(marker['id']), tu_id=0, c_id=0, group='0', data='__TangibleDemo__')
 
             # TODO: Correct IDs
@@ -280,28 +568,25 @@ class VIGITIASensorProcessingController:
                                                       width=movement['bounding_rect_width'],
                                                       height=movement['bounding_rect_height'], area=0)
 
-    # Find touch points on the table
-    def get_touch_points(self, color_image_table, depth_image_table, foreground_mask):
-        touch_points = []
-
-        print('Touch')
-
-        # Use the CNN Hand tracker only every other frame to improve performance
-        if self.frame_id % 2 == 0:
-            # TODO: Find solution for this temporary fix of ghost hands
-            self.hand_tracker.reset()
-            detected_hands = self.hand_tracker(cv2.cvtColor(color_image_table, cv2.COLOR_BGR2RGB))
-            hands, hand_regions = self.hand_tracker.add_hand_tracking_points(color_image_table.copy(), detected_hands)
-            if DEBUG_MODE:
-                cv2.imshow('hands', hands)
+    # Run the CNN hand tracker on the current frame. The preview of the hands is added to the given debug images
+    def get_detected_hands(self, color_image_table, debug_images):
+        # The palm detection only runs if needed. Otherwise the hands are tracked using their landmarks of the last frame
+        # The hand tracker converts the image to RGB itself while cropping it
+        detected_hands = self.hand_tracker.detect_and_track(color_image_table, bgr=True)
+        hands, hand_regions = self.hand_tracker.add_hand_tracking_points(color_image_table.copy(), detected_hands)
+        if DEBUG_MODE:
+            debug_images['hands'] = hands
 
-            self.detected_hands = detected_hands
-            self.hand_regions = hand_regions
+        return detected_hands, hand_regions
 
+    # Find touch points on the table
+    def get_touch_points(self, color_image_table, depth_image_table, foreground_mask, detected_hands, hand_regions):
         # Find the touch points using the TouchDetectionService
-        touch_points = self.touch_detector.get_touch_points(color_image_table, depth_image_table, self.hand_regions, self.detected_hands, foreground_mask)
+        return self.touch_detector.get_touch_points(color_image_table, depth_image_table, hand_regions,
+                                                    detected_hands, foreground_mask)
 
-        # Send out a TUIO pointer message for each touch point
+    # Send out a TUIO pointer message for each touch point
+    def add_touch_point_messages(self, touch_points):
         for touch_point in touch_points:
             # TODO: Add correct Type/User and Component ID
 
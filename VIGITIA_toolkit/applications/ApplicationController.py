@@ -6,6 +6,9 @@ from VIGITIA_toolkit.core.VIGITIABaseApplication import VIGITIABaseApplication
 
 class ApplicationController(QWidget, VIGITIABaseApplication):
 
+    # Tokens 1 to 6 select the application to show
+    subscription = {'component_types': ['tokens'], 'component_ids': range(1, 7)}
+
     selected_application_id = -1
 
     applications_dict = {1: 'BrowserWidget',
@@ -28,6 +28,9 @@ class Thread(QThread):
 
 class ImageWidget(QWidget, VIGITIABaseApplication):
 
+    # Only token 40 is used to show and rotate the image
+    subscription = {'component_types': ['tokens'], 'component_ids': {40}}
+
     image_rotation = 0
     last_time_token_seen = 0
     image_visible = False
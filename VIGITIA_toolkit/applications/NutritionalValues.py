@@ -21,6 +21,9 @@ class NutritionalValues(QWidget, VIGITIABaseApplication):
 
     """
 
+    # Bounding boxes of the food items and the smartphone
+    subscription = {'component_types': ['bounding_boxes'], 'session_ids': {10000, 10001, 10002, 10003, 10004, 10005}}
+
     present_tokens = []
 
     running = False
@@ -1,12 +1,16 @@
 
 import time
+import threading
 
-from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtCore import pyqtSignal, Qt
 
 from VIGITIA_toolkit.core.VIGITIASensorDataInterface import VIGITIASensorDataInterface
 
 #MIN_TIME_BEWEEN_UPDATES = 0.01  # sec
 
+# Deliver data from the sensor data interface to the applications in the Qt GUI thread using a queued signal
+QT_SIGNAL_BRIDGE = True
+
 
 class VIGITIABaseApplication:
     """ Parent class for all Toolkit applications.
@@ -23,6 +27,16 @@ class VIGITIABaseApplication:
 
     new_angle = pyqtSignal(str)
 
+    # Emitted when a new TUIO bundle is waiting to be delivered in the GUI thread
+    new_tuio_bundle_available = pyqtSignal()
+
+    # Applications can limit the data they receive from the sensor data interface (see VIGITIASubscriberSlot)
+    subscribed_message_types = None  # e.g. ['pointers', 'tokens']. None: All message types
+    max_update_rate = 0  # Maximum number of TUIO bundles per second. 0: No limit
+    # Components the application is interested in, e.g. {'component_types': ['tokens'], 'component_ids': {40}}
+    # (see VIGITIASubscriptionIndex). None: All components
+    subscription = None
+
     def __init__(self):
 
         self.name = ''
@@ -36,12 +50,19 @@ class VIGITIABaseApplication:
 
         self.z_index = 0
 
-        self.data_interface = VIGITIASensorDataInterface.Instance()
-        self.data_interface.register_subscriber(self)
-
         self.time_since_last_movement = 0
         self.time_since_last_rotation = 0
 
+        # Latest TUIO bundle (and the function to dispatch it) waiting for the GUI thread. See post_tuio_bundle()
+        self.pending_tuio_bundle = None
+        self.pending_tuio_bundle_lock = threading.Lock()
+        self.signal_bridge_connected = False
+
+        # Register last: Bundles can arrive as soon as the application is registered
+        self.data_interface = VIGITIASensorDataInterface.Instance()
+        self.data_interface.register_subscriber(self, self.subscribed_message_types, self.max_update_rate,
+                                                self.subscription)
+
     """
     Getter Functions
     """
@@ -85,6 +106,16 @@ class VIGITIABaseApplication:
 
         self.new_angle.connect(self.rendering_manager.rotate_applicaton)
 
+        if QT_SIGNAL_BRIDGE and not self.signal_bridge_connected:
+            self.new_tuio_bundle_available.connect(self.deliver_pending_tuio_bundle, Qt.QueuedConnection)
+            with self.pending_tuio_bundle_lock:
+                self.signal_bridge_connected = True
+                bundle_pending = self.pending_tuio_bundle is not None
+
+            # Deliver the bundle that arrived before the connection existed
+            if bundle_pending:
+                self.new_tuio_bundle_available.emit()
+
     def preset_dimensions(self):
         # If width or height is set to 0, make the application fullscreen. Also handle value <0 or larger than canvas
         if self.get_width() <= 0 or self.get_width() > self.rendering_manager.get_screen_resolution()[0]:
@@ -170,6 +201,16 @@ class VIGITIABaseApplication:
     def on_new_bounding_box_messages(self, data):
         pass
 
+    # The record arrays are only sent if COMPONENT_ARRAYS is enabled in the VIGITIASensorDataInterface
+    def on_new_token_array(self, data):
+        pass
+
+    def on_new_pointer_array(self, data):
+        pass
+
+    def on_new_bounding_box_array(self, data):
+        pass
+
     def on_new_data_messages(self, data):
         pass
 
@@ -183,6 +224,43 @@ class VIGITIABaseApplication:
     def on_key_pressed(self, event):
         pass
 
+    """
+        Qt signal bridge
+    """
+
+    def post_tuio_bundle(self, bundle, dispatch):
+        """ Called by the sensor data interface (from its own thread) for each new TUIO bundle.
+
+            The bundle is delivered to the callbacks above in the GUI thread. If the GUI thread has not picked up the
+            previous bundle yet, it is replaced by the new one. Only one signal is queued at a time. Until the signal
+            is connected in set_rendering_manager(), the latest bundle is only held back.
+
+            Parameters:
+                bundle (dict): The TUIO bundle
+                dispatch: Function that passes the bundle on to the callbacks of this application
+        """
+        if not QT_SIGNAL_BRIDGE:
+            dispatch(bundle)
+            return
+
+        with self.pending_tuio_bundle_lock:
+            signal_queued = self.pending_tuio_bundle is not None
+            self.pending_tuio_bundle = (bundle, dispatch)
+            signal_connected = self.signal_bridge_connected
+
+        if signal_connected and not signal_queued:
+            self.new_tuio_bundle_available.emit()
+
+    # Runs in the GUI thread
+    def deliver_pending_tuio_bundle(self):
+        with self.pending_tuio_bundle_lock:
+            pending_tuio_bundle = self.pending_tuio_bundle
+            self.pending_tuio_bundle = None
+
+        if pending_tuio_bundle is not None:
+            bundle, dispatch = pending_tuio_bundle
+            dispatch(bundle)
+
     """
         Private helper functions
     """
@@ -1,12 +1,30 @@
 
 
+import time
+import threading
+
+# Drivers that do not call notify_new_frame() are polled for new frames in this interval (in seconds), see get_frame_id()
+POLLING_INTERVAL = 0.01
+
+
 class VIGITIACameraBase:
 
+    # Drivers that call notify_new_frame() for every new frame need to set this to True. All other drivers need to
+    # implement get_frame_id() and are polled
+    frame_notifications = False
+
+    polled_frame_id = None  # Frame ID of the last polled frame that got a sequence number
+
     def __init__(self, camera_name):
         self.camera_name = camera_name
         self.available_video_streams = []
+        self.requested_video_streams = set()
+
+        # Each new frame of the camera gets a monotonically increasing sequence number
+        self.frame_sequence_number = 0
+        self.new_frame_condition = threading.Condition()
 
-    def add_video_stream(self, type, format, res_x, res_y, fps, description=''):
+    def add_video_stream(self, type, format, res_x, res_y, fps, description='', on_demand=False):
         """
         Add information about an available video stream
 
@@ -17,12 +35,157 @@ class VIGITIACameraBase:
             res_y (str): Description of arg1
             fps (str): Description of arg1
             description (str): Description of arg1
+            on_demand (bool): If True, the camera only produces this stream while it is requested by a consumer (see
+                              request_video_stream()). Otherwise the stream is always produced.
 
         """
         self.available_video_streams.append([type, format, res_x, res_y, fps, description])
+        if not on_demand:
+            self.requested_video_streams.add(type)
+
+    def request_video_stream(self, type):
+        """
+        Ask the camera to produce a video stream that is only available on demand
+
+        Parameters:
+            type (str): Type of the stream, as given in add_video_stream()
+
+        """
+        if type not in [stream[0] for stream in self.available_video_streams]:
+            raise ValueError('Video stream "{}" is not available for camera "{}"'.format(type, self.camera_name))
+        self.requested_video_streams.add(type)
+
+    def cancel_video_stream_request(self, type):
+        """
+        Let the camera know that a video stream requested via request_video_stream() is no longer needed
+
+        Parameters:
+            type (str): Type of the stream, as given in add_video_stream()
+
+        """
+        self.requested_video_streams.discard(type)
+
+    def is_video_stream_requested(self, type):
+        """
+        Drivers use this to check if they need to do the work for a video stream
+
+        Parameters:
+            type (str): Type of the stream, as given in add_video_stream()
+
+        """
+        return type in self.requested_video_streams
 
     def get_name(self):
         return self.camera_name
 
     def get_available_video_streams(self):
         return self.available_video_streams
+
+    def notify_new_frame(self, sequence_number=None):
+        """
+        Drivers call this every time a new frame is available to wake up consumers waiting in wait_for_next_frame().
+        They need to set frame_notifications to True, otherwise they are polled
+
+        Parameters:
+            sequence_number (int): Sequence number of the new frame. If None, the last sequence number is incremented
+
+        """
+        with self.new_frame_condition:
+            if sequence_number is None:
+                self.frame_sequence_number += 1
+            else:
+                self.frame_sequence_number = sequence_number
+            self.new_frame_condition.notify_all()
+
+    def get_frame_sequence_number(self):
+        with self.new_frame_condition:
+            return self.frame_sequence_number
+
+    def wait_for_next_frame(self, timeout=None, sequence_number=None):
+        """
+        Block until the camera has a frame that is newer than the given sequence number. If the driver does not call
+        notify_new_frame(), its frame ID is checked every POLLING_INTERVAL seconds instead
+
+        Parameters:
+            timeout (float): Maximum time to wait in seconds. None waits forever
+            sequence_number (int): Sequence number of the last frame the caller has seen. If None, wait for the next
+                                   frame after this call
+
+        Returns:
+            The sequence number of the latest frame or None if no new frame arrived before the timeout
+
+        """
+        if not self.frame_notifications:
+            return self.poll_for_next_frame(timeout, sequence_number)
+
+        with self.new_frame_condition:
+            if sequence_number is None:
+                sequence_number = self.frame_sequence_number
+
+            if self.new_frame_condition.wait_for(lambda: self.frame_sequence_number > sequence_number, timeout):
+                return self.frame_sequence_number
+            return None
+
+    # Same as wait_for_next_frame(), for drivers that do not call notify_new_frame()
+    def poll_for_next_frame(self, timeout, sequence_number):
+        end_time = None if timeout is None else time.time() + timeout
+
+        while True:
+            with self.new_frame_condition:
+                if sequence_number is None:
+                    sequence_number = self.frame_sequence_number
+
+                # Another consumer may already have given the latest frame a sequence number in borrow_frames()
+                if self.frame_sequence_number > sequence_number:
+                    return self.frame_sequence_number
+                if self.get_frame_id() != self.polled_frame_id:
+                    # Sequence number the frame will get in borrow_frames()
+                    return self.frame_sequence_number + 1
+
+            if end_time is not None and time.time() >= end_time:
+                return None
+            time.sleep(POLLING_INTERVAL)
+
+    def get_frame_id(self):
+        """
+        Returns an ID of the latest frame that changes with every new frame, e.g. a frame counter or the timestamp of the
+        frame (None if there is no frame yet). Only needed for drivers that do not call notify_new_frame()
+        """
+        raise NotImplementedError('Camera "{}" needs to call notify_new_frame() or implement get_frame_id()'.format(
+            self.camera_name))
+
+    def get_frames(self):
+        """
+        Returns copies of the latest frames of the camera. Needs to be implemented by each camera
+        """
+        raise NotImplementedError
+
+    def borrow_frames(self):
+        """
+        Get the latest frames of the camera without copying them, if supported by the camera
+
+        Returns:
+            A tuple of the sequence number of the frames followed by the frames. Borrowed frames must not be modified
+            and need to be given back with release_frames() once they are no longer needed.
+
+        """
+        # Drivers that notify about new frames need to store them while holding the lock of new_frame_condition, so
+        # that the sequence number matches the frames
+        with self.new_frame_condition:
+            if not self.frame_notifications:
+                # Without notifications, a frame only gets a new sequence number if the frame ID of the driver changed
+                frame_id = self.get_frame_id()
+                if frame_id != self.polled_frame_id:
+                    self.polled_frame_id = frame_id
+                    self.frame_sequence_number += 1
+            return (self.frame_sequence_number, *self.get_frames())
+
+    def release_frames(self, sequence_number):
+        """
+        Give frames borrowed via borrow_frames() back to the camera
+
+        Parameters:
+            sequence_number (int): Sequence number returned by borrow_frames()
+
+        """
+        pass
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+
+import numpy as np
+
+# Number of frames per file. At 1280x720, a chunk of color and depth frames needs about 4.6 MB per frame in memory
+CHUNK_SIZE = 30
+# Compress the chunks with zlib (np.savez_compressed). The files get smaller, but compressing a chunk takes much longer
+# than the camera needs to fill it, so the recorder would have to drop most of the chunks. Only for low resolutions
+COMPRESS_CHUNKS = False
+# Maximum number of chunks waiting to be written. If the disk can not keep up, further chunks are dropped instead of
+# filling up the memory
+MAX_QUEUED_CHUNKS = 4
+
+FRAME_TIMEOUT = 0.1  # Maximum time in seconds to wait for a new camera frame before checking if the recorder is stopped
+
+METADATA_FILE = 'recording.json'
+CHUNK_FILE = 'chunk_{:05d}.npz'
+
+
+class VIGITIACameraRecorder:
+    """ Records the frames of any camera derived from VIGITIACameraBase to disk
+
+        The color and depth frames are copied into preallocated arrays, which are written to disk in chunks of
+        CHUNK_SIZE frames by a separate thread. Each chunk is a .npz file containing the
+        arrays 'color', 'depth' (if the camera provides depth frames), 'timestamps' and 'sequence_numbers'. A JSON file
+        with information about the camera and the recording is written at the start and updated after each chunk, so
+        the recording can be played back even if the recorder is not stopped properly.
+
+        Recordings can be played back with the ReplayCamera.
+
+    """
+
+    def __init__(self, camera, output_directory, chunk_size=CHUNK_SIZE, compress=COMPRESS_CHUNKS):
+        """
+        Parameters:
+            camera (VIGITIACameraBase): The camera to record. It needs to be started already
+            output_directory (str): Directory for the recording. It is created if it does not exist yet
+            chunk_size (int): Number of frames per file
+            compress (bool): Compress the files
+        """
+        self.camera = camera
+        self.output_directory = output_directory
+        self.chunk_size = chunk_size
+        self.compress = compress
+
+        self.num_frames = 0
+        self.num_chunks = 0
+        self.num_written_frames = 0
+        self.num_dropped_frames = 0
+        self.start_time = None
+
+        self.current_chunk = None
+
+        # Chunks are written in a separate thread so that no frames are lost while a chunk is written to disk
+        self.chunk_queue = queue.Queue(maxsize=MAX_QUEUED_CHUNKS)
+
+        self.started = False
+
+    def start(self):
+        if self.started:
+            print('[VIGITIACameraRecorder]: Already running')
+            return None
+        else:
+            os.makedirs(self.output_directory, exist_ok=True)
+            self.write_metadata()
+            print('[VIGITIACameraRecorder]: Recording camera "{}" to {}'.format(self.camera.get_name(),
+                                                                                  self.output_directory))
+
+            self.started = True
+            self.thread = threading.Thread(target=self.update, args=())
+            self.thread.start()
+            self.writer_thread = threading.Thread(target=self.write_chunks, args=())
+            self.writer_thread.start()
+            return self
+
+    def update(self):
+        sequence_number = self.camera.get_frame_sequence_number()
+
+        while self.started:
+            if self.camera.wait_for_next_frame(FRAME_TIMEOUT, sequence_number) is None:
+                continue
+
+            sequence_number, color_image, depth_image = self.camera.borrow_frames()
+            if color_image is not None:
+                self.add_frame(sequence_number, color_image, depth_image)
+            self.camera.release_frames(sequence_number)
+
+        # Write the remaining frames
+        if self.current_chunk is not None:
+            self.chunk_queue.put(self.current_chunk)
+        self.chunk_queue.put(None)
+
+    def add_frame(self, sequence_number, color_image, depth_image):
+        now = time.time()
+        if self.start_time is None:
+            self.start_time = now
+
+        if self.current_chunk is None:
+            self.current_chunk = self.create_chunk(self.chunk_size, color_image, depth_image)
+        chunk = self.current_chunk
+        i = chunk['num_frames']
+
+        # The frames are only borrowed from the camera, so they need to be copied. They are copied directly into the
+        # arrays of the chunk, so no further copy is needed to write them
+        chunk['color'][i] = color_image
+        if chunk['depth'] is not None and depth_image is not None:
+            chunk['depth'][i] = depth_image
+        chunk['timestamps'][i] = now - self.start_time
+        chunk['sequence_numbers'][i] = sequence_number
+        chunk['num_frames'] += 1
+        self.num_frames += 1
+
+        if chunk['num_frames'] >= self.chunk_size:
+            try:
+                self.chunk_queue.put_nowait(chunk)
+            except queue.Full:
+                self.num_dropped_frames += chunk['num_frames']
+                print('[VIGITIACameraRecorder]: ERROR: Writing to disk is too slow. Dropped {} frames ({} in total). '
+                      'The recording will have gaps'.format(chunk['num_frames'], self.num_dropped_frames),
+                      file=sys.stderr)
+            self.current_chunk = None
+
+    @staticmethod
+    def create_chunk(chunk_size, color_image, depth_image):
+        return {
+            'color': np.empty((chunk_size, *color_image.shape), dtype=color_image.dtype),
+            'depth': None if depth_image is None else np.empty((chunk_size, *depth_image.shape),
+                                                               dtype=depth_image.dtype),
+            'timestamps': np.empty(chunk_size, dtype=np.float64),
+            'sequence_numbers': np.empty(chunk_size, dtype=np.int64),
+            'num_frames': 0
+        }
+
+    def write_chunks(self):
+        while True:
+            chunk = self.chunk_queue.get()
+            if chunk is None:
+                break
+
+            # The last chunk can be incomplete
+            num_frames = chunk['num_frames']
+            arrays = {key: chunk[key][:num_frames] for key in ['color', 'depth', 'timestamps', 'sequence_numbers']
+                      if chunk[key] is not None}
+
+            path = os.path.join(self.output_directory, CHUNK_FILE.format(self.num_chunks))
+            if self.compress:
+                np.savez_compressed(path, **arrays)
+            else:
+                np.savez(path, **arrays)
+            self.num_chunks += 1
+            self.num_written_frames += num_frames
+
+            self.write_metadata()
+
+    def write_metadata(self):
+        metadata = {
+            'camera_name': self.camera.get_name(),
+            'resolution': list(self.camera.get_resolution()),
+            'available_video_streams': self.camera.get_available_video_streams(),
+            'num_frames': self.num_written_frames,
+            'num_chunks': self.num_chunks,
+            'chunk_size': self.chunk_size
+        }
+
+        # Replace the file at once, so that it is never read while only partly written
+        path = os.path.join(self.output_directory, METADATA_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(metadata, file, indent=4)
+        os.replace(path + '.tmp', path)
+
+    def stop(self):
+        self.started = False
+        self.thread.join()
+        self.writer_thread.join()
+
+        print('[VIGITIACameraRecorder]: Recorded {} frames in {} chunks'.format(self.num_written_frames,
+                                                                               self.num_chunks))
+        if self.num_dropped_frames > 0:
+            print('[VIGITIACameraRecorder]: ERROR: {} of {} frames have been dropped because writing to disk was too '
+                  'slow'.format(self.num_dropped_frames, self.num_frames), file=sys.stderr)
+
+
+# Record the RealSense camera until enter is pressed
+def main():
+    from VIGITIA_toolkit.sensors.cameras.realsense_D435_camera import RealsenseD435Camera
+
+    if len(sys.argv) < 2:
+        print('Usage: VIGITIACameraRecorder.py <output directory>')
+        sys.exit(1)
+
+    camera = RealsenseD435Camera()
+    camera.init_video_capture()
+    camera.start()
+
+    recorder = VIGITIACameraRecorder(camera, sys.argv[1])
+    recorder.start()
+
+    input('Press enter to stop the recording\n')
+
+    recorder.stop()
+    camera.stop()
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
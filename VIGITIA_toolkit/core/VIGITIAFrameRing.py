@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+import numpy as np
+
+
+class VIGITIAFrameRing:
+    """ Ring of preallocated frame buffers to pass camera frames from a capture thread to consumers without copying.
+
+        The capture thread writes each new set of images (e.g. color and depth) into the next free buffer and publishes
+        it with a monotonically increasing sequence number. Consumers borrow the latest published buffer and get
+        read-only views of its images. A borrowed buffer will not be overwritten until it is released again.
+
+    """
+
+    def __init__(self, num_buffers, num_images):
+        """
+        Parameters:
+            num_buffers (int): Number of preallocated buffers. Needs to be larger than the number of frames that
+                               consumers borrow at the same time, otherwise new frames are dropped.
+            num_images (int): Number of images per frame, e.g. 2 for a color and a depth image
+        """
+        self.num_buffers = num_buffers
+        self.num_images = num_images
+
+        # Buffers are allocated on the first write, when the shapes of the images are known
+        self.buffers = None
+        self.read_only_views = None
+
+        self.sequence_numbers = [None] * num_buffers
+        self.borrow_counts = [0] * num_buffers
+
+        self.sequence_number = 0
+        self.latest_buffer = None
+        self.next_buffer = 0
+
+        self.num_dropped_frames = 0
+
+        self.lock = threading.Lock()
+
+    def write(self, *images):
+        """ Copy the given images into the next free buffer and publish it.
+
+            Returns the sequence number of the published frame or None if all buffers are currently borrowed.
+        """
+        with self.lock:
+            if self.buffers is None:
+                self.allocate_buffers(images)
+
+            index = self.find_free_buffer()
+            if index is None:
+                self.num_dropped_frames += 1
+                return None
+
+        # The free buffer is neither published nor borrowed, so it can be written without holding the lock
+        for buffer, image in zip(self.buffers[index], images):
+            if buffer is not None:
+                np.copyto(buffer, image)
+
+        with self.lock:
+            self.sequence_number += 1
+            self.sequence_numbers[index] = self.sequence_number
+            self.latest_buffer = index
+
+            return self.sequence_number
+
+    def borrow(self):
+        """ Borrow the latest published frame.
+
+            Returns a tuple of the sequence number followed by read-only views of the images (or None values if no
+            frame has been published yet). Each borrowed frame needs to be given back using release().
+        """
+        with self.lock:
+            if self.latest_buffer is None:
+                return (None, ) * (1 + self.num_images)
+
+            index = self.latest_buffer
+            self.borrow_counts[index] += 1
+
+            return (self.sequence_numbers[index], *self.read_only_views[index])
+
+    def release(self, sequence_number):
+        """ Give a borrowed frame back so that its buffer can be reused """
+        with self.lock:
+            for index in range(self.num_buffers):
+                if self.sequence_numbers[index] == sequence_number and self.borrow_counts[index] > 0:
+                    self.borrow_counts[index] -= 1
+                    return
+
+    def get_sequence_number(self):
+        """ Sequence number of the latest published frame (0 if no frame has been published yet) """
+        with self.lock:
+            return self.sequence_number
+
+    def allocate_buffers(self, images):
+        self.buffers = []
+        self.read_only_views = []
+
+        for _ in range(self.num_buffers):
+            buffers = [None if image is None else np.empty_like(image) for image in images]
+            read_only_views = []
+            for buffer in buffers:
+                if buffer is None:
+                    read_only_views.append(None)
+                else:
+                    view = buffer.view()
+                    view.flags.writeable = False
+                    read_only_views.append(view)
+
+            self.buffers.append(buffers)
+            self.read_only_views.append(read_only_views)
+
+    # Find the next buffer that is neither the latest published one nor borrowed by a consumer
+    def find_free_buffer(self):
+        for i in range(self.num_buffers):
+            index = (self.next_buffer + i) % self.num_buffers
+            if index != self.latest_buffer and self.borrow_counts[index] == 0:
+                self.next_buffer = (index + 1) % self.num_buffers
+                return index
+
+        return None
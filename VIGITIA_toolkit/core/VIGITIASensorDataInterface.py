@@ -2,12 +2,16 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import asyncio
 import threading
 
+import numpy as np
+from VIGITIA_toolkit.core.VIGITIASubscriberSlot import VIGITIASubscriberSlot
+from VIGITIA_toolkit.core.VIGITIASubscriptionIndex import VIGITIASubscriptionIndex
 from VIGITIA_toolkit.data_transportation.VIGITIAVideoStreamReceiver import VIGITIAVideoStreamReceiver
 from VIGITIA_toolkit.utility.get_ip import get_ip_address
 
-from pythonosc.osc_server import ThreadingOSCUDPServer
+from pythonosc.osc_server import BlockingOSCUDPServer, AsyncIOOSCUDPServer
 from pythonosc.dispatcher import Dispatcher
 
 # Port where this application will listen for incoming TUIO messages
@@ -15,6 +19,55 @@ PORT = 8000
 
 DEBUG_MODE = False
 
+# Receive TUIO messages on an asyncio event loop instead of a blocking socket server. By default, the event loop runs in
+# its own thread. Qt applications can pass their own event loop using use_event_loop() to receive the data directly in
+# the Qt main thread
+ASYNCIO_RECEIVER = False
+
+# Pass new TUIO bundles to each subscriber in its own thread. A subscriber that is still busy only receives the newest
+# bundle afterwards and skips stale ones. If disabled, all subscribers are called one after another in the receiving thread
+SUBSCRIBER_SLOTS = True
+
+# Formats in which the components of a frame are passed on to the subscribers:
+# Lists of dicts (one per component) and/or one NumPy record array per component type (e.g. for vectorized hit testing)
+COMPONENT_DICTS = True
+COMPONENT_ARRAYS = False
+
+# Fields of the component messages in the order they are sent. Also used as keys of the component dicts
+TOKEN_FIELDS = ('session_id', 'tuio_id', 'component_id', 'x_pos', 'y_pos', 'angle')
+POINTER_FIELDS = ('session_id', 'tuio_id', 'component_id', 'x_pos', 'y_pos', 'angle', 'shear', 'radius', 'press')
+BOUNDING_BOX_FIELDS = ('session_id', 'x_pos', 'y_pos', 'angle', 'width', 'height', 'area')
+
+# Data types of the component record arrays. Positions and sizes are translated to screen coordinates, but not rounded
+TOKEN_DTYPE = np.dtype([('session_id', np.int32), ('tuio_id', np.int32), ('component_id', np.int32),
+                        ('x_pos', np.float32), ('y_pos', np.float32), ('angle', np.float32)])
+POINTER_DTYPE = np.dtype([('session_id', np.int32), ('tuio_id', np.int32), ('component_id', np.int32),
+                          ('x_pos', np.float32), ('y_pos', np.float32), ('angle', np.float32),
+                          ('shear', np.float32), ('radius', np.float32), ('press', np.float32)])
+BOUNDING_BOX_DTYPE = np.dtype([('session_id', np.int32), ('x_pos', np.float32), ('y_pos', np.float32),
+                               ('angle', np.float32), ('width', np.float32), ('height', np.float32),
+                               ('area', np.float32)])
+
+# Event loop for the asyncio receiver. Set with use_event_loop()
+event_loop = None
+
+
+def use_event_loop(loop):
+    """ Run the asyncio TUIO receiver on the given event loop instead of a new one in a separate thread.
+
+        Needs to be called before the VIGITIASensorDataInterface is created. Example for a Qt application using qasync:
+
+            app = QApplication(sys.argv)
+            loop = qasync.QEventLoop(app)
+            asyncio.set_event_loop(loop)
+            use_event_loop(loop)
+
+        Parameters:
+            loop (asyncio.AbstractEventLoop): The event loop that is run by the application
+    """
+    global event_loop
+    event_loop = loop
+
 
 # The Singleton class is implemented like described here:
 # https://medium.com/better-programming/singleton-in-python-5eaa66618e3d
@@ -51,9 +104,23 @@ class VIGITIASensorDataInterface:
 
         # Using the Observer pattern
         self.subscribers = set()
-
+        # Each subscriber gets a slot that delivers the TUIO bundles to it
+        self.subscriber_slots = {}
+        # Subscribers can restrict the components they receive. Only matching components are routed to them
+        self.subscription_index = VIGITIASubscriptionIndex()
+
+        # Double buffer for each origin: Incoming messages are added to the staging bundle. Once the alive message
+        # completes the frame, the staging bundle is swapped into the published bundles and a new one is started
+        self.staging_bundles = {}
         self.bundles = {}
 
+        # Large frames are split by the TUIOServer into several bundles with the same frame ID. Only the last one
+        # contains the alive message. Keep track of the frame ID that is currently being received for each origin
+        self.incomplete_frame_ids = {}
+
+        # The TUIOServer only sends components that changed. Keep track of all present components for each origin
+        self.component_states = {}
+
         self.tokens = []
         self.pointers = []
         self.outer_contour_geometries = []
@@ -67,11 +134,35 @@ class VIGITIASensorDataInterface:
 
         self.init_tuio_interface()
 
-    def register_subscriber(self, new_subscriber):
+    def register_subscriber(self, new_subscriber, message_types=None, max_update_rate=0, subscription=None):
+        """ Register a new subscriber for incoming data
+
+            Parameters:
+                new_subscriber: Object implementing the callbacks of the VIGITIABaseApplication
+                message_types (list): Message types the subscriber wants to receive, e.g. ['pointers', 'tokens'].
+                                      See VIGITIASubscriberSlot.MESSAGE_TYPES. None: All message types
+                max_update_rate (float): Maximum number of TUIO bundles per second for this subscriber. 0: No limit
+                subscription (dict): Components the subscriber wants to receive, e.g. {'component_types': ['tokens'],
+                                     'component_ids': {40}}. See VIGITIASubscriptionIndex. None: All components
+        """
+        if new_subscriber in self.subscribers:
+            return
+
+        if subscription is not None:
+            self.subscription_index.add_subscription(new_subscriber, subscription)
+
+        slot = VIGITIASubscriberSlot(new_subscriber, message_types, max_update_rate)
+        if SUBSCRIBER_SLOTS:
+            slot.start()
+        self.subscriber_slots[new_subscriber] = slot
         self.subscribers.add(new_subscriber)
 
     def unregister_subscriber(self, subscriber):
         self.subscribers.discard(subscriber)
+        self.subscription_index.remove_subscription(subscriber)
+        slot = self.subscriber_slots.pop(subscriber, None)
+        if slot is not None and SUBSCRIBER_SLOTS:
+            slot.stop()
 
     def init_tuio_interface(self):
         dispatcher = Dispatcher()
@@ -84,13 +175,42 @@ class VIGITIASensorDataInterface:
         dispatcher.map("/tuio2/alv", self.on_new_alive_message, needs_reply_address=True)
 
         print('IP, PORT', self.ip, PORT)
-        osc_udp_server = ThreadingOSCUDPServer((self.ip, PORT), dispatcher)
+
+        if ASYNCIO_RECEIVER:
+            self.init_asyncio_tuio_interface(dispatcher)
+            return
+
+        # All datagrams are handled one after another in a single thread. This keeps the messages of a frame in order
+        # and avoids starting a new thread for each datagram
+        osc_udp_server = BlockingOSCUDPServer((self.ip, PORT), dispatcher)
 
         print('[SensorDataInterface]: Listening on {} for incoming TUIO messages'.format(osc_udp_server.server_address))
 
         server_thread = threading.Thread(target=osc_udp_server.serve_forever)
         server_thread.start()
 
+    # Each datagram is parsed as a whole in a single callback of the event loop and dispatched to the message handlers
+    def init_asyncio_tuio_interface(self, dispatcher):
+        loop = event_loop
+        run_own_loop = loop is None
+        if run_own_loop:
+            loop = asyncio.new_event_loop()
+
+        osc_udp_server = AsyncIOOSCUDPServer((self.ip, PORT), dispatcher, loop)
+
+        print('[SensorDataInterface]: Listening on {} for incoming TUIO messages (asyncio)'.format((self.ip, PORT)))
+
+        if run_own_loop:
+            def run_event_loop():
+                loop.run_until_complete(osc_udp_server.create_serve_endpoint())
+                loop.run_forever()
+
+            server_thread = threading.Thread(target=run_event_loop)
+            server_thread.start()
+        else:
+            # The endpoint is created as soon as the application starts running its event loop
+            asyncio.ensure_future(osc_udp_server.create_serve_endpoint(), loop=loop)
+
     # Init a new video stream receiver and subscribe to it to receive new video streams
     def init_video_stream_receiver(self, name, origin_ip, port):
         receiver = VIGITIAVideoStreamReceiver(name, origin_ip, port=port)
@@ -116,10 +236,16 @@ class VIGITIASensorDataInterface:
         if DEBUG_MODE:
             print('New frame arrived:', messages)
         origin_ip = messages[0][0]
+        frame_id = messages[2]
 
-        self.bundles[origin_ip] = {
+        # Another part of a frame that is still being received: Keep adding the components to the same bundle
+        if self.incomplete_frame_ids.get(origin_ip) == frame_id:
+            return
+        self.incomplete_frame_ids[origin_ip] = frame_id
+
+        self.staging_bundles[origin_ip] = {
             'origin_ip': origin_ip,
-            'frame_id': messages[2],
+            'frame_id': frame_id,
             'time_tag': messages[3],
             'dimension': messages[4],
             'source': messages[5],
@@ -172,16 +298,9 @@ class VIGITIASensorDataInterface:
         if DEBUG_MODE:
             print(messages)
 
+        # Only the message arguments are stored. Coordinates are translated once the frame is complete
         origin_ip = messages[0][0]
-        token_message = {
-            'session_id': messages[2],
-            'tuio_id': messages[3],
-            'component_id': messages[4],
-            'x_pos': self.translate_x_coordinate(messages[5]),
-            'y_pos': self.translate_y_coordinate(messages[6]),
-            'angle': messages[7]
-        }
-        self.bundles[origin_ip]['tokens'].append(token_message)
+        self.staging_bundles[origin_ip]['tokens'].append(messages[2:])
 
     def on_new_pointer_message(self, *messages):
 
@@ -189,31 +308,11 @@ class VIGITIASensorDataInterface:
             self.get_screen_resolution()
 
         origin_ip = messages[0][0]
-        pointer_message = {
-            'session_id': messages[2],
-            'tuio_id': messages[3],
-            'component_id': messages[4],
-            'x_pos': self.translate_x_coordinate(messages[5]),
-            'y_pos': self.translate_y_coordinate(messages[6]),
-            'angle': messages[7],
-            'shear': messages[8],
-            'radius': messages[9],
-            'press': messages[10]
-        }
-        self.bundles[origin_ip]['pointers'].append(pointer_message)
+        self.staging_bundles[origin_ip]['pointers'].append(messages[2:])
 
     def on_new_bounding_box_message(self, *messages):
         origin_ip = messages[0][0]
-        bounding_box_message = {
-            'session_id': messages[2],
-            'x_pos': self.translate_x_coordinate(messages[3]),
-            'y_pos': self.translate_y_coordinate(messages[4]),
-            'angle': messages[5],
-            'width': self.translate_x_coordinate(messages[6]),
-            'height': self.translate_x_coordinate(messages[7]),
-            'area': messages[8]
-        }
-        self.bundles[origin_ip]['bounding_boxes'].append(bounding_box_message)
+        self.staging_bundles[origin_ip]['bounding_boxes'].append(messages[2:])
 
     def on_new_data_message(self, *messages):
 
@@ -221,7 +320,7 @@ class VIGITIASensorDataInterface:
             print(messages)
 
         origin_ip = messages[0][0]
-        self.bundles[origin_ip]['data'].append(messages[2:])
+        self.staging_bundles[origin_ip]['data'].append(messages[2:])
 
         message_type = messages[3]
         # Messages of type video indicate the presence of a video stream
@@ -251,25 +350,110 @@ class VIGITIASensorDataInterface:
     def on_new_alive_message(self, *messages):
         origin_ip = messages[0][0]
         active_session_ids = messages[2:]
-        self.bundles[origin_ip]['active_session_ids'].append(active_session_ids)
+
+        # The alive message completes the frame. Take the staging bundle so that the next frame starts in a new one
+        bundle = self.staging_bundles.pop(origin_ip)
+        bundle['active_session_ids'].append(active_session_ids)
+        self.incomplete_frame_ids.pop(origin_ip, None)
+
+        self.update_component_states(origin_ip, bundle, active_session_ids)
+
+        if COMPONENT_ARRAYS:
+            self.create_component_arrays(bundle)
+        if COMPONENT_DICTS:
+            self.create_component_dicts(bundle)
+        else:
+            bundle['tokens'], bundle['pointers'], bundle['bounding_boxes'] = [], [], []
+
+        # Publish the completed bundle. Readers of self.bundles never see a frame that is still being assembled
+        self.bundles[origin_ip] = bundle
 
         if DEBUG_MODE:
-            print(self.bundles[origin_ip])
+            print(bundle)
 
-        # Send new data to all subscribers
+        # Send new data to all subscribers: The entire bundle and just certain components for quicker data access
+        # Subscribers with a subscription only get the components they are interested in
+        routed_bundles = self.subscription_index.route(bundle)
         try:
-            for subscriber in self.subscribers:
-                # The entire bundle
-                subscriber.on_new_tuio_bundle(self.bundles[origin_ip])
-
-                # Just certain components for quicker data access
-                subscriber.on_new_token_messages(self.bundles[origin_ip]['tokens'])
-                subscriber.on_new_pointer_messages(self.bundles[origin_ip]['pointers'])
-                subscriber.on_new_bounding_box_messages(self.bundles[origin_ip]['bounding_boxes'])
+            for subscriber, slot in list(self.subscriber_slots.items()):
+                subscriber_bundle = routed_bundles.get(subscriber, bundle)
+                if SUBSCRIBER_SLOTS:
+                    slot.put(subscriber_bundle)
+                else:
+                    slot.dispatch(subscriber_bundle)
         except RuntimeError as error:
             # Handle rare cases when the self.subscribers set changes while it is read
             print(error)
 
+    # Merge the components received in the current bundle with the components that are still alive but have not changed
+    # since the last frame. Afterwards the bundle contains all present components again
+    def update_component_states(self, origin_ip, bundle, active_session_ids):
+        component_states = self.component_states.setdefault(origin_ip, {})
+        active_session_ids = set(active_session_ids)
+
+        for component_type in ['tokens', 'pointers', 'bounding_boxes']:
+            state = component_states.setdefault(component_type, {})
+
+            # The first argument of each component message is its session ID
+            for component in bundle[component_type]:
+                state[component[0]] = component
+
+            for session_id in list(state.keys()):
+                if session_id not in active_session_ids:
+                    del state[session_id]
+
+            bundle[component_type] = list(state.values())
+
+    # Convert the message arguments of all components into dicts with their coordinates translated to screen space
+    def create_component_dicts(self, bundle):
+        tokens = []
+        for values in bundle['tokens']:
+            token = dict(zip(TOKEN_FIELDS, values))
+            token['x_pos'] = self.translate_x_coordinate(token['x_pos'])
+            token['y_pos'] = self.translate_y_coordinate(token['y_pos'])
+            tokens.append(token)
+
+        pointers = []
+        for values in bundle['pointers']:
+            pointer = dict(zip(POINTER_FIELDS, values))
+            pointer['x_pos'] = self.translate_x_coordinate(pointer['x_pos'])
+            pointer['y_pos'] = self.translate_y_coordinate(pointer['y_pos'])
+            pointers.append(pointer)
+
+        bounding_boxes = []
+        for values in bundle['bounding_boxes']:
+            bounding_box = dict(zip(BOUNDING_BOX_FIELDS, values))
+            bounding_box['x_pos'] = self.translate_x_coordinate(bounding_box['x_pos'])
+            bounding_box['y_pos'] = self.translate_y_coordinate(bounding_box['y_pos'])
+            bounding_box['width'] = self.translate_x_coordinate(bounding_box['width'])
+            bounding_box['height'] = self.translate_x_coordinate(bounding_box['height'])
+            bounding_boxes.append(bounding_box)
+
+        bundle['tokens'] = tokens
+        bundle['pointers'] = pointers
+        bundle['bounding_boxes'] = bounding_boxes
+
+    # Convert the message arguments of each component type into a single record array. All coordinates of a component
+    # type are translated to screen space in one step
+    def create_component_arrays(self, bundle):
+        token_array = np.array(bundle['tokens'], dtype=TOKEN_DTYPE).view(np.recarray)
+        pointer_array = np.array(bundle['pointers'], dtype=POINTER_DTYPE).view(np.recarray)
+        bounding_box_array = np.array(bundle['bounding_boxes'], dtype=BOUNDING_BOX_DTYPE).view(np.recarray)
+
+        if self.camera_resolution is not None and self.screen_resolution is not None:
+            scale_x = self.screen_resolution[0] / self.camera_resolution[0]
+            scale_y = self.screen_resolution[1] / self.camera_resolution[1]
+
+            for array in [token_array, pointer_array, bounding_box_array]:
+                array.x_pos *= scale_x
+                array.y_pos *= scale_y
+            bounding_box_array.width *= scale_x
+            bounding_box_array.height *= scale_y
+
+        bundle['token_array'] = token_array
+        bundle['pointer_array'] = pointer_array
+        bundle['bounding_box_array'] = bounding_box_array
+
     # Applications can call this function to ask what video streams are available
     def get_available_video_streams(self):
         return self.available_video_streams
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import time
+
+# Message types a subscriber can subscribe to: Name of the callback and key of the data in the TUIO bundle
+# (None: the entire bundle)
+MESSAGE_TYPES = {
+    'tuio_bundle': ('on_new_tuio_bundle', None),
+    'tokens': ('on_new_token_messages', 'tokens'),
+    'pointers': ('on_new_pointer_messages', 'pointers'),
+    'bounding_boxes': ('on_new_bounding_box_messages', 'bounding_boxes'),
+    'token_array': ('on_new_token_array', 'token_array'),
+    'pointer_array': ('on_new_pointer_array', 'pointer_array'),
+    'bounding_box_array': ('on_new_bounding_box_array', 'bounding_box_array'),
+}
+
+
+class VIGITIASubscriberSlot:
+    """ Delivers TUIO bundles to a single subscriber of the VIGITIASensorDataInterface in its own thread.
+
+        The slot only holds the latest bundle. If the subscriber is still busy with a previous bundle (or its maximum
+        update rate does not allow an update yet), a newer bundle replaces the waiting one and the stale one is skipped.
+        A slow subscriber therefore neither blocks the reception of new data nor delays other subscribers.
+
+    """
+
+    def __init__(self, subscriber, message_types=None, max_update_rate=0):
+        """
+        Parameters:
+            subscriber: The subscriber that will receive the bundles
+            message_types (list): Names of the message types the subscriber is interested in (see MESSAGE_TYPES).
+                                  None: All message types
+            max_update_rate (float): Maximum number of bundles per second that are passed on to the subscriber.
+                                     0: No limit
+        """
+        self.subscriber = subscriber
+
+        if message_types is None:
+            message_types = MESSAGE_TYPES.keys()
+        for message_type in message_types:
+            if message_type not in MESSAGE_TYPES:
+                raise ValueError('[VIGITIASubscriberSlot]: Unknown message type "{}"'.format(message_type))
+        self.callbacks = [(getattr(subscriber, MESSAGE_TYPES[message_type][0]), MESSAGE_TYPES[message_type][1])
+                          for message_type in message_types]
+
+        self.min_update_interval = 1 / max_update_rate if max_update_rate > 0 else 0
+        self.last_update_time = 0
+
+        self.latest_bundle = None
+        self.num_skipped_bundles = 0
+        self.condition = threading.Condition()
+
+        self.started = False
+
+    def start(self):
+        if self.started:
+            print('[VIGITIASubscriberSlot]: Already running')
+            return None
+        else:
+            self.started = True
+            self.thread = threading.Thread(target=self.update, daemon=True)
+            self.thread.start()
+            return self
+
+    def stop(self):
+        with self.condition:
+            self.started = False
+            self.condition.notify()
+
+        # A subscriber can unsubscribe from within one of its callbacks, i.e. in the thread of the slot
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    # Put a new bundle into the slot. A bundle that has not been passed on to the subscriber yet is replaced
+    def put(self, bundle):
+        with self.condition:
+            if self.latest_bundle is not None:
+                self.num_skipped_bundles += 1
+            self.latest_bundle = bundle
+            self.condition.notify()
+
+    def update(self):
+        while self.started:
+            with self.condition:
+                while self.latest_bundle is None and self.started:
+                    self.condition.wait()
+
+            # Respect the maximum update rate. Bundles arriving in the meantime replace the waiting one
+            time_to_wait = self.last_update_time + self.min_update_interval - time.time()
+            if time_to_wait > 0:
+                time.sleep(time_to_wait)
+
+            with self.condition:
+                bundle = self.latest_bundle
+                self.latest_bundle = None
+
+            if bundle is None:
+                continue
+
+            self.last_update_time = time.time()
+            try:
+                self.dispatch(bundle)
+            except Exception as e:
+                # An error in a subscriber must not stop the delivery of further bundles
+                print('[VIGITIASubscriberSlot]: Error in subscriber {}: {}'.format(type(self.subscriber).__name__,
+                                                                                  repr(e)), file=sys.stderr)
+
+    # Pass the bundle on to the subscriber. Subscribers can provide a post_tuio_bundle() function to decide in which
+    # thread the callbacks are called (see VIGITIABaseApplication)
+    def dispatch(self, bundle):
+        post_tuio_bundle = getattr(self.subscriber, 'post_tuio_bundle', None)
+        if post_tuio_bundle is not None:
+            post_tuio_bundle(bundle, self.call_callbacks)
+        else:
+            self.call_callbacks(bundle)
+
+    # Call the callbacks of all subscribed message types
+    def call_callbacks(self, bundle):
+        for callback, key in self.callbacks:
+            if key is None:
+                callback(bundle)
+            elif key in bundle:
+                callback(bundle[key])
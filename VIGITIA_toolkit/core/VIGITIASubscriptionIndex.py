@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# Component types of a TUIO bundle and the keys of their record arrays
+COMPONENT_TYPES = {
+    'tokens': 'token_array',
+    'pointers': 'pointer_array',
+    'bounding_boxes': 'bounding_box_array',
+}
+
+# Bounding boxes have no component ID
+ID_FIELDS = ['component_id', 'session_id']
+
+# Ranges of IDs up to this length are added to the index like sets. Longer ranges are checked by their bounds
+MAX_INDEXED_RANGE_LENGTH = 1000
+
+
+class VIGITIASubscriptionIndex:
+    """ Routes the components of a TUIO bundle only to the subscribers that are interested in them.
+
+        A subscription is a dict that can contain the following (optional) entries:
+            'component_types': List of component types, e.g. ['tokens', 'bounding_boxes']. Default: All types
+            'component_ids': Set, list or range of component IDs (e.g. the marker ID of a token)
+            'session_ids': Set, list or range of session IDs
+            'region': Rectangle (x, y, width, height) in screen coordinates the components need to be in
+
+        Subscriptions with a set, list or small range of IDs are stored in an index by ID. For each component, only
+        these subscribers and the ones with large ranges or without ID filter need to be checked.
+
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+
+        # component type -> ID field -> ID -> subscribers
+        self.id_index = {}
+        # component type -> subscribers that need to be checked for every component of this type
+        self.unindexed_subscribers = {}
+
+    def add_subscription(self, subscriber, subscription):
+        for component_type in subscription.get('component_types', COMPONENT_TYPES.keys()):
+            if component_type not in COMPONENT_TYPES:
+                raise ValueError('[VIGITIASubscriptionIndex]: Unknown component type "{}"'.format(component_type))
+
+        self.subscriptions[subscriber] = subscription
+        self.rebuild_index()
+
+    def remove_subscription(self, subscriber):
+        if self.subscriptions.pop(subscriber, None) is not None:
+            self.rebuild_index()
+
+    def rebuild_index(self):
+        id_index = {component_type: {id_field: {} for id_field in ID_FIELDS} for component_type in COMPONENT_TYPES}
+        unindexed_subscribers = {component_type: [] for component_type in COMPONENT_TYPES}
+
+        for subscriber, subscription in self.subscriptions.items():
+            for component_type in subscription.get('component_types', COMPONENT_TYPES.keys()):
+                index_field = self.get_index_field(subscription, component_type)
+                if index_field is None:
+                    unindexed_subscribers[component_type].append(subscriber)
+                    continue
+
+                for component_id in subscription[index_field + 's']:
+                    id_index[component_type][index_field].setdefault(component_id, []).append(subscriber)
+
+        # Replace the index as a whole, so that route() can be called from another thread in the meantime
+        self.id_index = id_index
+        self.unindexed_subscribers = unindexed_subscribers
+
+    # Field used to index the subscription for the given component type. Large ranges are not indexed
+    @staticmethod
+    def get_index_field(subscription, component_type):
+        for id_field in ID_FIELDS:
+            if id_field == 'component_id' and component_type == 'bounding_boxes':
+                continue
+            ids = subscription.get(id_field + 's')
+            if ids is not None and (not isinstance(ids, range) or len(ids) <= MAX_INDEXED_RANGE_LENGTH):
+                return id_field
+        return None
+
+    def route(self, bundle):
+        """ Create a filtered copy of the bundle for each subscriber with a subscription
+
+            Returns:
+                Dict subscriber -> filtered bundle. Subscribers without subscription are not included and receive the
+                complete bundle.
+        """
+        subscriptions = self.subscriptions
+        if len(subscriptions) == 0:
+            return {}
+
+        id_index = self.id_index
+        unindexed_subscribers = self.unindexed_subscribers
+
+        routed_components = {subscriber: {component_type: [] for component_type in COMPONENT_TYPES}
+                             for subscriber in subscriptions}
+
+        for component_type in COMPONENT_TYPES:
+            type_index = id_index[component_type]
+            for component in bundle.get(component_type, []):
+                candidates = list(unindexed_subscribers[component_type])
+                for id_field in ID_FIELDS:
+                    candidates += type_index[id_field].get(component.get(id_field), [])
+
+                # A subscriber can be a candidate more than once if it is indexed by more than one ID field
+                for subscriber in set(candidates):
+                    if self.matches(subscriptions[subscriber], component):
+                        routed_components[subscriber][component_type].append(component)
+
+        routed_bundles = {}
+        for subscriber, components in routed_components.items():
+            routed_bundle = dict(bundle)
+            routed_bundle.update(components)
+
+            for component_type, array_key in COMPONENT_TYPES.items():
+                if array_key in bundle:
+                    routed_bundle[array_key] = self.filter_array(subscriptions[subscriber], component_type,
+                                                                 bundle[array_key])
+
+            routed_bundles[subscriber] = routed_bundle
+
+        return routed_bundles
+
+    @staticmethod
+    def matches(subscription, component):
+        for id_field in ID_FIELDS:
+            ids = subscription.get(id_field + 's')
+            if ids is not None and component.get(id_field) not in ids:
+                return False
+
+        region = subscription.get('region')
+        if region is not None:
+            x, y, width, height = region
+            if not (x <= component['x_pos'] <= x + width and y <= component['y_pos'] <= y + height):
+                return False
+
+        return True
+
+    # Same as matches(), but for all components in a record array at once
+    @staticmethod
+    def filter_array(subscription, component_type, array):
+        if component_type not in subscription.get('component_types', COMPONENT_TYPES.keys()):
+            return array[:0]
+
+        mask = np.ones(len(array), dtype=bool)
+        for id_field in ID_FIELDS:
+            ids = subscription.get(id_field + 's')
+            if ids is None:
+                continue
+            if id_field not in array.dtype.names:
+                return array[:0]
+            mask &= VIGITIASubscriptionIndex.is_in(array[id_field], ids)
+
+        region = subscription.get('region')
+        if region is not None:
+            x, y, width, height = region
+            mask &= (array['x_pos'] >= x) & (array['x_pos'] <= x + width)
+            mask &= (array['y_pos'] >= y) & (array['y_pos'] <= y + height)
+
+        return array[mask]
+
+    # Vectorized version of "value in ids". Ranges are checked by their bounds, so they are never expanded
+    @staticmethod
+    def is_in(values, ids):
+        if not isinstance(ids, range):
+            return np.isin(values, np.fromiter(ids, dtype=np.int64, count=len(ids)))
+
+        if len(ids) == 0:
+            return np.zeros(len(values), dtype=bool)
+        if ids.step < 0:
+            ids = ids[::-1]
+
+        return (values >= ids.start) & (values < ids.stop) & ((values - ids.start) % ids.step == 0)
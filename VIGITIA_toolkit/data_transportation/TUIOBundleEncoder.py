@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+import sys
+import timeit
+
+BUNDLE_HEADER = b'#bundle\x00' + struct.pack('>Q', 1)  # Bundle identifier followed by the time tag "immediately"
+INITIAL_BUFFER_SIZE = 4096  # bytes
+
+
+# OSC type tag of an integer, chosen like python-osc does: int64 for values that do not fit into an int32
+def get_int_type_tag(value):
+    return 'h' if value.bit_length() > 31 else 'i'
+
+
+# Encode a string as OSC string: null-terminated and padded with null bytes to a multiple of 4 bytes
+def encode_osc_string(value):
+    value = value.encode('utf-8')
+    return value + b'\x00' * (4 - len(value) % 4)
+
+
+class TUIOMessageLayout:
+    """ Precompiled layout of a TUIO message with a fixed number of int32 and float32 arguments
+
+        The address, the type tags and the message size never change, so they are encoded only once.
+    """
+
+    def __init__(self, address, type_tags):
+        self.struct = struct.Struct('>' + type_tags)
+        prefix = encode_osc_string(address) + encode_osc_string(',' + type_tags)
+
+        # Each element of an OSC bundle is preceded by its size
+        self.header = struct.pack('>i', len(prefix) + self.struct.size) + prefix
+        self.size = len(self.header) + self.struct.size
+
+
+class TUIOBundleEncoder:
+    """ Encoder for TUIO 2.0 bundles that writes all messages of a bundle directly into a single reusable bytearray
+
+        The fixed-layout messages (/tuio2/ptr, /tuio2/tok, /tuio2/bnd) are packed with precompiled struct formats.
+        The output is byte-compatible with bundles built with python-osc's OscBundleBuilder and OscMessageBuilder
+        using the same argument types.
+    """
+
+    # /tuio2/ptr s_id tu_id c_id x_pos y_pos angle shear radius press (all values are sent as int32 for now)
+    POINTER_LAYOUT = TUIOMessageLayout('/tuio2/ptr', 'iiiiiiiii')
+    # /tuio2/tok s_id tu_id c_id x_pos y_pos angle
+    TOKEN_LAYOUT = TUIOMessageLayout('/tuio2/tok', 'iiifff')
+    # /tuio2/bnd s_id x_pos y_pos angle width height area
+    BOUNDING_BOX_LAYOUT = TUIOMessageLayout('/tuio2/bnd', 'iffffff')
+
+    SYMBOL_PREFIX = encode_osc_string('/tuio2/sym') + encode_osc_string(',iiiss')
+    SYMBOL_STRUCT = struct.Struct('>iii')
+    # The frame time tag exceeds the int32 range after about 24.8 days. Then it is sent as int64 (see add_frame_message())
+    FRAME_LAYOUTS = {}
+    ALIVE_ADDRESS = encode_osc_string('/tuio2/alv')
+
+    SIZE_STRUCT = struct.Struct('>i')
+
+    def __init__(self):
+        self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+        self.length = 0
+
+        # Start offsets of all messages in the buffer, needed to split large bundles
+        self.message_offsets = []
+
+        # Structs for alive messages, cached by the number of session IDs
+        self.alive_structs = {}
+
+    def start_bundle(self):
+        """ Start a new bundle. The buffer of the previous bundle is reused """
+        self.length = 0
+        self.message_offsets = []
+        self.write(BUNDLE_HEADER)
+
+    def get_bundle(self):
+        """ Returns the encoded bundle as memoryview of the internal buffer.
+
+            The view is only valid until the next bundle is started.
+        """
+        return memoryview(self.buffer)[:self.length]
+
+    def get_fragments(self, max_size):
+        """ Returns the encoded bundle split into several bundles that are not larger than max_size bytes.
+
+            The first message of the bundle (the frame message) is repeated at the beginning of every fragment, the
+            remaining messages are distributed in their original order. The last message (the alive message) therefore
+            only ends up in the last fragment. A single message that does not fit into max_size gets its own fragment.
+        """
+        if self.length <= max_size or len(self.message_offsets) < 2:
+            return [self.get_bundle()]
+
+        buffer = memoryview(self.buffer)
+        offsets = self.message_offsets + [self.length]
+        frame_message = bytes(buffer[offsets[0]:offsets[1]])
+        fragment_header = BUNDLE_HEADER + frame_message
+
+        fragments = []
+        start = offsets[1]
+        for i in range(2, len(offsets)):
+            # Close the current fragment if the next message does not fit anymore
+            if offsets[i] - start + len(fragment_header) > max_size and offsets[i - 1] > start:
+                fragments.append(fragment_header + buffer[start:offsets[i - 1]])
+                start = offsets[i - 1]
+        fragments.append(fragment_header + buffer[start:self.length])
+
+        return fragments
+
+    def add_frame_message(self, frame_id, time_tag, dimension, source):
+        type_tags = get_int_type_tag(frame_id) + get_int_type_tag(time_tag) + get_int_type_tag(dimension)
+        prefix, frame_struct = self.get_frame_layout(type_tags)
+        self.add_message(prefix, frame_struct.pack(frame_id, time_tag, dimension) + encode_osc_string(source))
+
+    # Encoded prefix and struct of a frame message with the given type tags of the integer arguments
+    @classmethod
+    def get_frame_layout(cls, type_tags):
+        if type_tags not in cls.FRAME_LAYOUTS:
+            prefix = encode_osc_string('/tuio2/frm') + encode_osc_string(',' + type_tags + 's')
+            cls.FRAME_LAYOUTS[type_tags] = (prefix, struct.Struct('>' + type_tags.replace('h', 'q')))
+        return cls.FRAME_LAYOUTS[type_tags]
+
+    def add_pointer_message(self, s_id, tu_id, c_id, x_pos, y_pos, angle, shear, radius, press):
+        self.add_fixed_layout_message(self.POINTER_LAYOUT, s_id, tu_id, c_id, x_pos, y_pos, angle, shear, radius,
+                                      press)
+
+    def add_token_message(self, s_id, tu_id, c_id, x_pos, y_pos, angle):
+        self.add_fixed_layout_message(self.TOKEN_LAYOUT, s_id, tu_id, c_id, x_pos, y_pos, angle)
+
+    def add_bounding_box_message(self, s_id, x_pos, y_pos, angle, width, height, area):
+        self.add_fixed_layout_message(self.BOUNDING_BOX_LAYOUT, s_id, x_pos, y_pos, angle, width, height, area)
+
+    def add_symbol_message(self, s_id, tu_id, c_id, group, data):
+        self.add_message(self.SYMBOL_PREFIX, self.SYMBOL_STRUCT.pack(s_id, tu_id, c_id) + encode_osc_string(group) +
+                         encode_osc_string(data))
+
+    def add_alive_message(self, session_ids):
+        alive_struct = self.alive_structs.get(len(session_ids))
+        if alive_struct is None:
+            alive_struct = struct.Struct('>' + 'i' * len(session_ids))
+            self.alive_structs[len(session_ids)] = alive_struct
+
+        prefix = self.ALIVE_ADDRESS + encode_osc_string(',' + 'i' * len(session_ids))
+        self.add_message(prefix, alive_struct.pack(*session_ids))
+
+    def add_encoded_message(self, message):
+        """ Add a message that has already been encoded, e.g. by python-osc's OscMessageBuilder """
+        self.add_message(b'', message)
+
+    def add_fixed_layout_message(self, layout, *args):
+        self.reserve(layout.size)
+        self.message_offsets.append(self.length)
+
+        self.buffer[self.length:self.length + len(layout.header)] = layout.header
+        layout.struct.pack_into(self.buffer, self.length + len(layout.header), *args)
+        self.length += layout.size
+
+    def add_message(self, prefix, arguments):
+        self.reserve(self.SIZE_STRUCT.size + len(prefix) + len(arguments))
+        self.message_offsets.append(self.length)
+
+        self.SIZE_STRUCT.pack_into(self.buffer, self.length, len(prefix) + len(arguments))
+        self.length += self.SIZE_STRUCT.size
+        self.write(prefix)
+        self.write(arguments)
+
+    def write(self, data):
+        self.reserve(len(data))
+        self.buffer[self.length:self.length + len(data)] = data
+        self.length += len(data)
+
+    # Make sure that the given number of bytes still fit into the buffer
+    def reserve(self, num_bytes):
+        if self.length + num_bytes > len(self.buffer):
+            self.buffer.extend(bytearray(max(len(self.buffer), num_bytes)))
+
+
+# Micro-benchmark comparing the encoder with python-osc's builders. Both need to produce the same bytes
+def main():
+    from pythonosc import osc_bundle_builder
+    from pythonosc import osc_message_builder
+
+    num_touches = 20
+    num_markers = 20
+    num_runs = 1000
+
+    def build_with_python_osc(time_tag=1000):
+        bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+
+        frame_message = osc_message_builder.OscMessageBuilder(address='/tuio2/frm')
+        for arg in [1, time_tag, 83886800, 'VIGITIA']:
+            frame_message.add_arg(arg)
+        bundle.add_content(frame_message.build())
+
+        for i in range(num_touches):
+            pointer_message = osc_message_builder.OscMessageBuilder(address='/tuio2/ptr')
+            for arg in [i, 0, 0, 100 + i, 200 + i, 0, 0, 0, 1]:
+                pointer_message.add_arg(arg)
+            bundle.add_content(pointer_message.build())
+
+        for i in range(num_markers):
+            symbol_message = osc_message_builder.OscMessageBuilder(address='/tuio2/sym')
+            for arg in [1000 + i, 0, 0, '0', '__TangibleDemo__']:
+                symbol_message.add_arg(arg)
+            bundle.add_content(symbol_message.build())
+
+            token_message = osc_message_builder.OscMessageBuilder(address='/tuio2/tok')
+            for arg in [1000 + i, 0, i, 10.5, 20.25, 90.0]:
+                token_message.add_arg(arg)
+            bundle.add_content(token_message.build())
+
+            bounding_box_message = osc_message_builder.OscMessageBuilder(address='/tuio2/bnd')
+            for arg in [1000 + i, 10.5, 20.25, 90.0, 50.0, 50.0, 0.0]:
+                bounding_box_message.add_arg(arg)
+            bundle.add_content(bounding_box_message.build())
+
+        alive_message = osc_message_builder.OscMessageBuilder(address='/tuio2/alv')
+        for i in list(range(num_touches)) + [1000 + i for i in range(num_markers)]:
+            alive_message.add_arg(i)
+        bundle.add_content(alive_message.build())
+
+        return bundle.build().dgram
+
+    encoder = TUIOBundleEncoder()
+
+    def build_with_encoder(time_tag=1000):
+        encoder.start_bundle()
+        encoder.add_frame_message(1, time_tag, 83886800, 'VIGITIA')
+
+        for i in range(num_touches):
+            encoder.add_pointer_message(i, 0, 0, 100 + i, 200 + i, 0, 0, 0, 1)
+
+        for i in range(num_markers):
+            encoder.add_symbol_message(1000 + i, 0, 0, '0', '__TangibleDemo__')
+            encoder.add_token_message(1000 + i, 0, i, 10.5, 20.25, 90.0)
+            encoder.add_bounding_box_message(1000 + i, 10.5, 20.25, 90.0, 50.0, 50.0, 0.0)
+
+        encoder.add_alive_message(list(range(num_touches)) + [1000 + i for i in range(num_markers)])
+
+        return encoder.get_bundle()
+
+    # Also compare a frame time tag that does not fit into an int32 any more (after about 24.8 days of uptime)
+    for time_tag in [1000, 2 ** 31 + 1000]:
+        if build_with_python_osc(time_tag) != bytes(build_with_encoder(time_tag)):
+            print('[TUIOBundleEncoder]: Encoded bundles differ for time tag {}'.format(time_tag), file=sys.stderr)
+            sys.exit(1)
+
+    time_python_osc = timeit.timeit(build_with_python_osc, number=num_runs) / num_runs * 1000
+    time_encoder = timeit.timeit(build_with_encoder, number=num_runs) / num_runs * 1000
+
+    print('[TUIOBundleEncoder]: Bundle with {} pointers and {} tokens ({} bytes)'.format(
+        num_touches, num_markers, len(build_with_encoder())))
+    print('[TUIOBundleEncoder]: python-osc: {:.3f} ms per bundle'.format(time_python_osc))
+    print('[TUIOBundleEncoder]: TUIOBundleEncoder: {:.3f} ms per bundle'.format(time_encoder))
+
+
+if __name__ == '__main__':
+    main()
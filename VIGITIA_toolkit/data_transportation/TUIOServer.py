@@ -2,10 +2,28 @@
 # -*- coding: utf-8 -*-
 
 import time
+import socket
+import ipaddress
 from pythonosc import udp_client
 from pythonosc import osc_bundle_builder
 from pythonosc import osc_message_builder
 
+from VIGITIA_toolkit.data_transportation.TUIOBundleEncoder import TUIOBundleEncoder, BUNDLE_HEADER
+
+# Encode bundles with the TUIOBundleEncoder instead of python-osc's message builders (much faster, same output)
+NATIVE_TUIO_ENCODER = True
+
+# Only send component messages (ptr, tok, bnd, sym) that changed since the last frame. The alive message still lists
+# all present session IDs
+SEND_ONLY_UPDATES = True
+FULL_UPDATE_INTERVAL = 30  # Send all component messages every X frames, e.g. for clients that connect later
+
+# Frames that do not fit into a single UDP datagram of this size are split into several bundles with the same frame ID.
+# 1400 bytes stay below the usual Ethernet MTU of 1500 bytes (minus IP and UDP headers) to avoid IP fragmentation
+MAX_BUNDLE_SIZE = 1400
+
+MULTICAST_TTL = 1  # Number of network hops for bundles sent to a multicast group. 1: Only the local network
+
 
 class TUIOServer:
     """ Basic python implementation of a TUIO 2.0 server
@@ -23,19 +41,38 @@ class TUIOServer:
     # Global variable to store the current TUIO Bundle
     current_tuio_frame_bundle = None
     current_frame_id = 0
+    full_update = True
 
     def __init__(self, ip, port=8000):
         """ Create a new instance of the TUIO server.
 
-            With the current implementation, one instance is needed per target computer
+            Each bundle is encoded only once and the same bytes are sent to all target computers.
 
             Parameters:
-                ip (str): IP address of the target computer
-                port: Port of the target computer that should be used
+                ip (str or list): IP address of the target computer or a list of IP addresses or (ip, port) tuples
+                                  for multiple target computers. Multicast group addresses are supported as well.
+                port: Port of the target computers that should be used if no port is given with the IP address
         """
-        self.udp_client = udp_client.SimpleUDPClient(ip, port)
+        if isinstance(ip, str):
+            ip = [ip]
+        self.targets = [target if isinstance(target, tuple) else (target, port) for target in ip]
+
+        if NATIVE_TUIO_ENCODER:
+            self.encoder = TUIOBundleEncoder()
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if any(ipaddress.ip_address(target_ip).is_multicast for target_ip, _ in self.targets):
+                self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        else:
+            self.udp_clients = [udp_client.SimpleUDPClient(target_ip, target_port)
+                                for target_ip, target_port in self.targets]
+
         self.start_time_ms = int(round(time.time() * 1000))
 
+        # Session registry: The last sent arguments for each message type of all present session IDs
+        self.sessions = {}
+        # Session IDs present in the current frame, in the order they were added (dict used as ordered set)
+        self.current_session_ids = {}
+
     def init_tuio_frame(self, dimension, source):
         """ FRM (frame message)
 
@@ -52,6 +89,9 @@ class TUIOServer:
         time_now_ms = int(round(time.time() * 1000))
         frame_time_tag = time_now_ms - self.start_time_ms
 
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.add_frame_message(int(self.current_frame_id), frame_time_tag, dimension, source)
+            return None
 
         frame_message = osc_message_builder.OscMessageBuilder(address="/tuio2/frm")
         frame_message.add_arg(int(self.current_frame_id))  #
@@ -83,33 +123,39 @@ class TUIOServer:
             (Source: http://www.tuio.org/?tuio20)
         """
 
+        # tu_id refers to type/user and can be 0 for now
+        # c_id for touch points and hands refers to the individual finger (index, ring, thumb, …) or hand (left/right)
+        args = (int(s_id), int(tu_id), int(c_id), float(x_pos), float(y_pos), float(angle))
+        if not self.update_session('tok', args):
+            return
+
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.add_token_message(*args)
+            return
+
         token_message = osc_message_builder.OscMessageBuilder(address="/tuio2/tok")
-        token_message.add_arg(s_id)
-        token_message.add_arg(tu_id)  # tu_id refers to type/user and can be 0 for now
-        token_message.add_arg(c_id)  # c_id for touch points and hands refers to the individual finger (index, ring, thumb, …) or hand (left/right)
-        token_message.add_arg(x_pos)
-        token_message.add_arg(y_pos)
-        token_message.add_arg(angle)
+        for arg in args:
+            token_message.add_arg(arg)
         self.current_tuio_frame_bundle.add_content(token_message.build())
 
-    alive_ids = []
-
     # /tuio2/ptr s_id tu_id c_id x_pos y_pos angle shear radius press [x_vel y_vel p_vel m_acc p_acc]
     # /tuio2/ptr int32 int32 int32 float float float float float [float float float float float]
     def add_pointer_message(self, s_id, tu_id, c_id, x_pos, y_pos, angle, shear, radius, press):
 
-        self.alive_ids.append(s_id)
+        # tu_id refers to type/user and can be 0 for now
+        # c_id for touch points and hands refers to the individual finger (index, ring, thumb, …) or hand (left/right)
+        args = (int(s_id), int(tu_id), int(c_id), int(x_pos), int(y_pos), int(angle), int(shear), int(radius),
+                int(press))
+        if not self.update_session('ptr', args):
+            return
+
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.add_pointer_message(*args)
+            return
 
         pointer_message = osc_message_builder.OscMessageBuilder(address="/tuio2/ptr")
-        pointer_message.add_arg(int(s_id))
-        pointer_message.add_arg(int(tu_id))  # tu_id refers to type/user and can be 0 for now
-        pointer_message.add_arg(int(c_id))  # c_id for touch points and hands refers to the individual finger (index, ring, thumb, …) or hand (left/right)
-        pointer_message.add_arg(int(x_pos))
-        pointer_message.add_arg(int(y_pos))
-        pointer_message.add_arg(int(angle))
-        pointer_message.add_arg(int(shear))
-        pointer_message.add_arg(int(radius))
-        pointer_message.add_arg(int(press))
+        for arg in args:
+            pointer_message.add_arg(arg)
         self.current_tuio_frame_bundle.add_content(pointer_message.build())
 
     # /tuio2/ocg s_id x_p0 y_p0 ... x_pN y_pN
@@ -139,14 +185,17 @@ class TUIOServer:
 
         """
 
+        args = (int(s_id), float(x_pos), float(y_pos), float(angle), float(width), float(height), float(area))
+        if not self.update_session('bnd', args):
+            return
+
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.add_bounding_box_message(*args)
+            return
+
         bounding_box_message = osc_message_builder.OscMessageBuilder(address="/tuio2/bnd")
-        bounding_box_message.add_arg(s_id)
-        bounding_box_message.add_arg(x_pos)
-        bounding_box_message.add_arg(y_pos)
-        bounding_box_message.add_arg(angle)
-        bounding_box_message.add_arg(width)
-        bounding_box_message.add_arg(height)
-        bounding_box_message.add_arg(area)
+        for arg in args:
+            bounding_box_message.add_arg(arg)
         self.current_tuio_frame_bundle.add_content(bounding_box_message.build())
 
     # /tuio2/sym s_id tu_id c_id group data
@@ -173,12 +222,17 @@ class TUIOServer:
 
         """
 
+        args = (int(s_id), int(tu_id), int(c_id), str(group), str(data))
+        if not self.update_session('sym', args):
+            return
+
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.add_symbol_message(*args)
+            return
+
         symbol_message = osc_message_builder.OscMessageBuilder(address="/tuio2/sym")
-        symbol_message.add_arg(s_id)
-        symbol_message.add_arg(tu_id)
-        symbol_message.add_arg(c_id)
-        symbol_message.add_arg(group)
-        symbol_message.add_arg(data)
+        for arg in args:
+            symbol_message.add_arg(arg)
         self.current_tuio_frame_bundle.add_content(symbol_message.build())
 
     # /tuio2/skg s_id x_p0 y_p0 x_p1 y_p1 node ... x_pN y_pN
@@ -196,7 +250,7 @@ class TUIOServer:
 
         """
         skeleton_message = osc_message_builder.OscMessageBuilder(address="/tuio2/skg")
-        self.current_tuio_frame_bundle.add_content(skeleton_message.build())
+        self.add_message_to_bundle(skeleton_message)
 
     def add_data_message(self, s_id, mime, *data):
         """ DAT (data message)
@@ -222,7 +276,7 @@ class TUIOServer:
         for arg in data:
             data_message.add_arg(arg)
 
-        self.current_tuio_frame_bundle.add_content(data_message.build())
+        self.add_message_to_bundle(data_message)
 
     def add_control_message(self, s_id, *cN):
         """ CTL (control message)
@@ -248,10 +302,45 @@ class TUIOServer:
         for arg in cN:
             control_message.add_arg(arg)
 
-        self.current_tuio_frame_bundle.add_content(control_message.build())
+        self.add_message_to_bundle(control_message)
+
+    def update_session(self, message_type, args):
+        """ Register the component message of the given type in the session registry
+
+            Parameters:
+                message_type (str): 'ptr', 'tok', 'bnd' or 'sym'
+                args (tuple): Arguments of the message. The first one is the session ID
+
+            Returns:
+                True if the message needs to be sent, False if it has not changed since it was last sent
+        """
+        s_id = args[0]
+        self.current_session_ids[s_id] = None
+
+        session = self.sessions.setdefault(s_id, {})
+        if SEND_ONLY_UPDATES and not self.full_update and session.get(message_type) == args:
+            return False
+
+        session[message_type] = args
+        return True
+
+    # Messages without a fixed layout are still built with python-osc
+    def add_message_to_bundle(self, message_builder):
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.add_encoded_message(message_builder.build().dgram)
+        else:
+            self.current_tuio_frame_bundle.add_content(message_builder.build())
 
     def start_tuio_bundle(self, dimension, source):
         """ Start building a new TUIO bundle"""
+        self.full_update = self.current_frame_id % FULL_UPDATE_INTERVAL == 0
+        self.current_session_ids = {}
+
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.start_bundle()
+            self.init_tuio_frame(dimension, source)
+            return
+
         self.current_tuio_frame_bundle = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
 
         frame_message = self.init_tuio_frame(dimension, source)
@@ -259,22 +348,62 @@ class TUIOServer:
         self.current_tuio_frame_bundle.add_content(frame_message.build())
 
     def send_tuio_bundle(self):
-        alive_message = osc_message_builder.OscMessageBuilder(address="/tuio2/alv")
-        # TODO: Add a list of all active session IDs to the alive message
-        # This also means that components that are still present -> 'alive' but have not updated at the current frame
-        # should be included in the alive message but no other TUIO messages need to be sent.
-        alive_message.add_arg(5)
-        alive_message.add_arg(6)
+        # The alive message lists all session IDs present in this frame, including those whose messages have not been
+        # sent because they did not change. Sessions that are no longer present are removed from the registry.
+        alive_ids = list(self.current_session_ids)
+        for s_id in list(self.sessions):
+            if s_id not in self.current_session_ids:
+                del self.sessions[s_id]
+
+        if NATIVE_TUIO_ENCODER:
+            self.encoder.add_alive_message(alive_ids)
+
+            # Python's socket module offers no sendmmsg(), so the encoded bytes are sent to each target in turn
+            for bundle in self.encoder.get_fragments(MAX_BUNDLE_SIZE):
+                for target in self.targets:
+                    self.socket.sendto(bundle, target)
+            return
 
-        for alive_id in self.alive_ids:
+        alive_message = osc_message_builder.OscMessageBuilder(address="/tuio2/alv")
+        for alive_id in alive_ids:
             alive_message.add_arg(alive_id)
 
-        self.alive_ids = []
-
         self.current_tuio_frame_bundle.add_content(alive_message.build())
 
         bundle = self.current_tuio_frame_bundle.build()
 
-        self.udp_client.send(bundle)
+        for fragment in self.split_bundle(bundle):
+            for client in self.udp_clients:
+                client.send(fragment)
 
         self.current_tuio_frame_bundle = None
+
+    # Split a python-osc bundle that is larger than MAX_BUNDLE_SIZE into several bundles. Each of them starts with the
+    # frame message, the alive message is only part of the last one (see TUIOBundleEncoder.get_fragments())
+    def split_bundle(self, bundle):
+        if bundle.size <= MAX_BUNDLE_SIZE or bundle.num_contents < 2:
+            return [bundle]
+
+        frame_message = bundle.content(0)
+
+        fragments = []
+        fragment = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+        fragment.add_content(frame_message)
+        fragment_size = len(BUNDLE_HEADER) + 4 + frame_message.size
+        fragment_empty = True
+
+        for i in range(1, bundle.num_contents):
+            message = bundle.content(i)
+            if fragment_size + 4 + message.size > MAX_BUNDLE_SIZE and not fragment_empty:
+                fragments.append(fragment.build())
+                fragment = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+                fragment.add_content(frame_message)
+                fragment_size = len(BUNDLE_HEADER) + 4 + frame_message.size
+
+            fragment.add_content(message)
+            fragment_size += 4 + message.size
+            fragment_empty = False
+
+        fragments.append(fragment.build())
+
+        return fragments
@@ -20,6 +20,10 @@ class FiducialsDetectionService:
     marker_frame = None
 
     def __init__(self):
+        # Debug images of the last call of detect_fiducials(). They are shown by the caller, because OpenCV windows
+        # may only be used in the main thread
+        self.debug_images = {}
+
         self.init_aruco_tracking()
         print('[FiducialsDetectionService]: Ready')
 
@@ -38,12 +42,13 @@ class FiducialsDetectionService:
 
         aruco_markers = []
 
+        self.debug_images = {}
         if DEBUG_MODE:
             preview = frame_color.copy()
             # draw a square around the markers
             aruco.drawDetectedMarkers(preview, corners, ids)
 
-            cv2.imshow('marker', preview)
+            self.debug_images['marker'] = preview
 
         # check if the ids list is not empty
         if np.all(ids is not None):
@@ -5,8 +5,15 @@ import os
 
 import cv2
 import numpy as np
-import tensorflow as tf
-from sklearn.cluster import DBSCAN
+
+# Use the lightweight tflite_runtime package if it is installed. Otherwise the TFLite interpreter of tensorflow is used
+try:
+    import tflite_runtime.interpreter as tflite
+    OpResolverType = getattr(tflite, 'OpResolverType', None)
+except ImportError:
+    import tensorflow as tf
+    tflite = tf.lite
+    OpResolverType = getattr(tf.lite.experimental, 'OpResolverType', None)
 
 # Paths to the Models needed for hand tracking
 CNN_MODELS_FOLDER_NAME = 'cnn_models'
@@ -16,6 +23,28 @@ LANDMARK_MODEL_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), CN
 ANCHORS_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), CNN_MODELS_FOLDER_NAME, 'anchors.csv'))
 
 
+# Decoding of the palm detections: Minimum score of a detection and minimum overlap (IoU) of two detections to be
+# merged into a single palm by the weighted non-maximum suppression
+MIN_DETECTION_SCORE = 0.5
+MIN_SUPPRESSION_IOU = 0.3
+
+# Number of CPU threads each TFLite interpreter may use
+TFLITE_NUM_THREADS = 4
+# Use the XNNPACK delegate for faster CPU inference. It is applied by default by recent TFLite versions
+USE_XNNPACK = True
+
+# Run the landmark model once for all detected hands by resizing its input to a batch of (N, 256, 256, 3) crops.
+# If the model does not support a batch size larger than one, the hands are processed one after another
+BATCHED_LANDMARK_DETECTION = True
+LANDMARK_INPUT_SIZE = 256
+
+# Detect-then-track: The palm detection only runs if no hands are tracked, if the landmark model loses confidence in a
+# tracked hand or at least every DETECTION_INTERVAL frames. In between, the landmarks of the previous frame define the
+# crops of the hands in the next frame
+DETECTION_INTERVAL = 10
+MIN_TRACKING_CONFIDENCE = 0.5  # Minimum hand presence score of the landmark model to keep tracking a hand
+TRACKING_BOX_ENLARGE = 1.5  # Size of the crop of a tracked hand relative to the extent of its landmarks
+
 # Constants for drawing of the hand
 POINT_COLOR = (0, 255, 0)
 CONNECTION_COLOR = (255, 255, 0)
@@ -63,10 +92,8 @@ class HandLandmarkDetectionService:
 
     def __init__(self, box_enlarge=3.3, box_shift=0.2):
 
-        self.interp_palm = tf.lite.Interpreter(PALM_MODEL_PATH)
-        self.interp_palm.allocate_tensors()
-        self.interp_lm = tf.lite.Interpreter(LANDMARK_MODEL_PATH)
-        self.interp_lm.allocate_tensors()
+        self.interp_palm = self.create_interpreter(PALM_MODEL_PATH)
+        self.interp_lm = self.create_interpreter(LANDMARK_MODEL_PATH)
 
         # reading the SSD anchors
         with open(ANCHORS_PATH, "r") as csv_f:
@@ -83,8 +110,25 @@ class HandLandmarkDetectionService:
         self.out_clf_idx = output_details[1]['index']
 
         self.lm_reg_idx = output_details_lm[0]['index']
-
-        self.cluster = DBSCAN(eps=30, min_samples=1)
+        self.lm_in_idx = self.interp_lm.get_input_details()[0]['index']
+        # Hand presence score of the landmark model, if the model provides it
+        self.lm_flag_idx = output_details_lm[1]['index'] if len(output_details_lm) > 1 else None
+
+        # Hands of the last frame and number of frames since the palm detection has been run (see detect_and_track()).
+        # The tracked hands are in the same order as the rows of self.hands, self.sizes and self.dydx
+        self.tracked_hands = []
+        self.frames_since_detection = 0
+        self.hand_lost = False  # The landmark model lost confidence in a hand in the last frame
+
+        # Preallocated buffers for the crops of the hands. The input batch grows with the number of hands
+        self.batched_landmark_detection = BATCHED_LANDMARK_DETECTION
+        self.landmark_batch_size = 1
+        self.landmark_crop = np.empty((LANDMARK_INPUT_SIZE, LANDMARK_INPUT_SIZE, 3), dtype=np.uint8)
+        self.landmark_input = np.empty((1, LANDMARK_INPUT_SIZE, LANDMARK_INPUT_SIZE, 3), dtype=np.float32)
+
+        # Preallocated buffers for the input of the palm detection model
+        self.palm_crop = np.empty((256, 256, 3), dtype=np.uint8)
+        self.palm_input = np.empty((1, 256, 256, 3), dtype=np.float32)
 
         self.reset()
         self._target_box = np.float32([
@@ -96,6 +140,26 @@ class HandLandmarkDetectionService:
 
         print('[HandLandmarkDetectionService]: Ready')
 
+    @staticmethod
+    def create_interpreter(model_path, num_threads=TFLITE_NUM_THREADS, use_xnnpack=USE_XNNPACK):
+        """
+        creates a TFLite interpreter for the given model that uses multiple threads and (optionally) the XNNPACK
+        delegate
+        """
+        options = {'num_threads': num_threads}
+        if not use_xnnpack and OpResolverType is not None:
+            options['experimental_op_resolver_type'] = OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+
+        try:
+            interpreter = tflite.Interpreter(model_path=model_path, **options)
+        except TypeError:
+            # Older TFLite versions do not support these options
+            print('[HandLandmarkDetectionService]: Interpreter options not supported by this TFLite version')
+            interpreter = tflite.Interpreter(model_path=model_path)
+
+        interpreter.allocate_tensors()
+        return interpreter
+
     def reset(self):
         """
         resets hand tracking data. Should be used any time there's
@@ -138,13 +202,6 @@ class HandLandmarkDetectionService:
         hand['bbox'] = np.r_[[p0, p1, p2, p3]].astype('int')
         return hand
 
-    @staticmethod
-    def _im_normalize(img):
-        """
-        normalize all values into [-1, 1]
-        """
-        return np.ascontiguousarray(2 * ((img / 255) - 0.5).astype('float32'))
-
     @staticmethod
     def _sigm(x):
         return 1 / (1 + np.exp(-x))
@@ -154,34 +211,74 @@ class HandLandmarkDetectionService:
         return np.pad(x, ((0, 0), (0, 1)), constant_values=1, mode='constant')
 
     @staticmethod
-    def agg_hand(hand):
+    def weighted_nms(boxes, scores, min_iou=MIN_SUPPRESSION_IOU):
         """
-        method used to choose between multiple
-        hand detections in the same cluster
+        weighted non-maximum suppression as used by the MediaPipe palm detector.
+        Starting with the best detection, all remaining detections that overlap with it are merged into one.
+        Args:
+            boxes: (N,4) array of boxes as x_min, y_min, x_max, y_max
+            scores: (N,) array of detection scores
+        Output:
+            list of (index of the best detection, indices of all merged detections)
         """
-        idx = np.argmax(hand['score'])
-        return {k: v[idx] for k, v in hand.items()}
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        remaining = np.argsort(-scores)
+
+        clusters = []
+        while len(remaining) > 0:
+            best = remaining[0]
 
-    def preprocess_img(self, img):
+            x_min = np.maximum(boxes[best, 0], boxes[remaining, 0])
+            y_min = np.maximum(boxes[best, 1], boxes[remaining, 1])
+            x_max = np.minimum(boxes[best, 2], boxes[remaining, 2])
+            y_max = np.minimum(boxes[best, 3], boxes[remaining, 3])
+            intersection = np.maximum(x_max - x_min, 0) * np.maximum(y_max - y_min, 0)
+            iou = intersection / (areas[best] + areas[remaining] - intersection + 1e-6)
+
+            overlapping = iou > min_iou
+            clusters.append((best, remaining[overlapping]))
+            remaining = remaining[~overlapping]
+
+        return clusters
+
+    @staticmethod
+    def normalize_into(img, out, bgr=False):
         """
-        fit the image into a 256x256 square and normalizes it
+        normalize all values of the uint8 image into [-1, 1] and write them into
+        the preallocated float32 array. BGR images are converted to RGB on the way
+        """
+        if bgr:
+            img = img[..., ::-1]
+        np.multiply(img, 2 / 255, out=out, casting='unsafe')
+        out -= 1
+        return out
+
+    def preprocess_img(self, img, bgr=False):
+        """
+        fit the image into a 256x256 square (padded with black borders) and normalizes it.
+        Padding and resizing are done by a single affine warp into a preallocated buffer,
+        so no full-sized copies of the image are needed
         """
         shape = np.r_[img.shape]
         pad = (shape.max() - shape[:2]).astype('uint32') // 2
-        img_pad = np.pad(
-            img,
-            ((pad[0], pad[0]), (pad[1], pad[1]), (0, 0)),
-            mode='constant')
-        img_small = cv2.resize(img_pad, (256, 256))
-        img_small = np.ascontiguousarray(img_small)
+        padded_shape = shape[:2] + 2 * pad
+
+        # Scale and shift the image like np.pad followed by cv2.resize would (pixel centers are aligned)
+        scale_y, scale_x = 256 / padded_shape
+        Mtr = np.float32([
+            [scale_x, 0, (pad[1] + 0.5) * scale_x - 0.5],
+            [0, scale_y, (pad[0] + 0.5) * scale_y - 0.5]
+        ])
+        cv2.warpAffine(img, Mtr, (256, 256), dst=self.palm_crop, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
 
-        img_norm = self._im_normalize(img_small)
-        return img_pad, img_norm, pad
+        img_norm = self.normalize_into(self.palm_crop, self.palm_input[0], bgr)
+        scale = padded_shape[0] / 256
+        return img_norm, scale, pad
 
     def detect_hand(self, img_norm, scale=5, box_enlarge=2.5):
         """
-        runs the palm detection model, decodes possible detections, clusters them
-        and aggregates detections in the same clusters
+        runs the palm detection model, decodes possible detections and merges
+        overlapping detections using weighted non-maximum suppression
         """
         assert -1 <= img_norm.min() and img_norm.max() <= 1, \
             "img_norm should be in range [-1, 1]"
@@ -193,52 +290,53 @@ class HandLandmarkDetectionService:
         self.interp_palm.invoke()
 
         reg = self.interp_palm.get_tensor(self.out_reg_idx)[0]
-        clf = self.interp_palm.get_tensor(self.out_clf_idx).flatten().astype('float32').round(1)
+        clf = self.interp_palm.get_tensor(self.out_clf_idx).flatten()
 
-        centers = self.anchors[clf > 0][:, :2] * 256
+        # Only decode the anchors with a high enough score
+        scores = self._sigm(np.clip(clf, -100, 100))
+        detected = scores >= MIN_DETECTION_SCORE
+        if not np.any(detected):
+            return []
 
-        dydx = reg[clf > 0][:, :2]
-        wh = reg[clf > 0][:, 2:4]
-        landmarks = reg[clf > 0][:, 4:].reshape(-1, 7, 2)
-        clf = clf[clf > 0]
-        max_size = wh.max()
+        scores = scores[detected]
+        reg = reg[detected]
+        anchor_centers = self.anchors[detected][:, :2] * 256
 
-        landmarks = centers[:, None, :] + landmarks
-        centers += dydx[:, :2]
+        centers = anchor_centers + reg[:, :2]
+        wh = reg[:, 2:4]
+        landmarks = anchor_centers[:, None, :] + reg[:, 4:].reshape(-1, 7, 2)
 
-        split_centers = []
-        split_wh = []
-        split_landmarks = []
-        split_clf = []
-
-        self.cluster.eps = max_size
-        clusters = self.cluster.fit_predict(centers)
-        for i in set(clusters):
-            split_centers.append(centers[clusters == i])
-            split_wh.append(wh[clusters == i])
-            split_landmarks.append(landmarks[clusters == i])
-            split_clf.append(clf[clusters == i])
+        boxes = np.concatenate([centers - wh / 2, centers + wh / 2], axis=1)
 
         hands = []
-        for cnt, wh, lm, scr in zip(
-                split_centers, split_wh, split_landmarks, split_clf):
-            hands.append({'center': lm[:, 1, :] * scale,
-                          'size': wh.max(axis=-1) * box_enlarge * scale,
+        for best, merged in self.weighted_nms(boxes, scores):
+            # Average the detections that belong to the same palm, weighted by their scores
+            weights = scores[merged] / scores[merged].sum()
+            lm = np.tensordot(weights, landmarks[merged], axes=1)
+            size = (weights @ wh[merged]).max()
+
+            hands.append({'center': lm[1] * scale,
+                          'size': size * box_enlarge * scale,
                           'lm': lm * scale,
-                          'score': scr})
+                          'score': scores[best]})
 
-        return [self.agg_hand(h) for h in hands]
+        return hands
 
-    def track(self, hands):
+    def track(self, hands, gate_movement=True):
         """
         Makes sure that hands are ordered consistently
         between frames of a video and mitigates jitter.
+        If gate_movement is False, the new positions are taken over even if
+        the hands moved further than their size since they were last updated
         """
         lm_new = np.c_[[x['lm'] for x in hands]]
         sizes = np.c_[[x['size'] for x in hands]]
 
+        # Start over if the number of hands keeps differing from the tracked ones
         if len(self.hands) != len(lm_new):
             self.n_different += 1
+        else:
+            self.n_different = 0
         if self.n_different > 30:
             self.reset()
 
@@ -267,7 +365,7 @@ class HandLandmarkDetectionService:
 
             dydx = h[2] - self.hands[j][2]
 
-            if 10 < np.linalg.norm(dydx) < self.sizes[j]:
+            if not gate_movement or 10 < np.linalg.norm(dydx) < self.sizes[j]:
                 self.dydx[j] = 0.4 * self.dydx[j] + 0.6 * dydx
 
                 self.hands[j] = h
@@ -286,7 +384,7 @@ class HandLandmarkDetectionService:
 
         return self.hands.copy(), self.sizes.copy(), self.dydx.copy()
 
-    def get_landmarks(self, img, hand):
+    def get_landmarks(self, img, hand, bgr=False):
         """
         crops the hand image according to the bounding box,
         runs hand landmark detection models and projects
@@ -298,13 +396,72 @@ class HandLandmarkDetectionService:
             source[:3],
             self._target_box[:3]
         )
-        img_hand_np = cv2.warpAffine(img, Mtr, (256, 256))
-        img_hand = self._im_normalize(img_hand_np)
+        cv2.warpAffine(img, Mtr, (256, 256), dst=self.landmark_crop)
+        img_hand = self.normalize_into(self.landmark_crop, self.landmark_input[0], bgr)
 
-        self.interp_lm.set_tensor(0, img_hand[None])
+        self.interp_lm.set_tensor(self.lm_in_idx, img_hand[None])
         self.interp_lm.invoke()
 
         reg = self.interp_lm.get_tensor(self.lm_reg_idx)[0]
+
+        hand['joints'] = self.project_landmarks(reg, Mtr)
+        if self.lm_flag_idx is not None:
+            hand['confidence'] = float(self.interp_lm.get_tensor(self.lm_flag_idx).flatten()[0])
+        return hand
+
+    def get_landmarks_batch(self, img, hands, bgr=False):
+        """
+        crops all hand images into a single input batch, runs the hand landmark detection model once for all hands
+        and projects the obtained coordinates onto the full-sized image
+        """
+        num_hands = len(hands)
+        if num_hands == 0:
+            return hands
+
+        if num_hands > len(self.landmark_input):
+            self.landmark_input = np.empty((num_hands, LANDMARK_INPUT_SIZE, LANDMARK_INPUT_SIZE, 3), dtype=np.float32)
+
+        transforms = []
+        for i, hand in enumerate(hands):
+            Mtr = cv2.getAffineTransform(hand['bbox'].astype('float32')[:3], self._target_box[:3])
+            transforms.append(Mtr)
+
+            # Crop into the preallocated buffer and normalize it into [-1, 1] directly in the input batch
+            cv2.warpAffine(img, Mtr, (LANDMARK_INPUT_SIZE, LANDMARK_INPUT_SIZE), dst=self.landmark_crop)
+            self.normalize_into(self.landmark_crop, self.landmark_input[i], bgr)
+
+        try:
+            if num_hands != self.landmark_batch_size:
+                self.interp_lm.resize_tensor_input(self.lm_in_idx,
+                                                   [num_hands, LANDMARK_INPUT_SIZE, LANDMARK_INPUT_SIZE, 3])
+                self.interp_lm.allocate_tensors()
+                self.landmark_batch_size = num_hands
+
+            self.interp_lm.set_tensor(self.lm_in_idx, self.landmark_input[:num_hands])
+            self.interp_lm.invoke()
+        except (ValueError, RuntimeError) as error:
+            print('[HandLandmarkDetectionService]: Batched landmark detection not supported by the model:', error)
+            self.batched_landmark_detection = False
+            self.interp_lm.resize_tensor_input(self.lm_in_idx, [1, LANDMARK_INPUT_SIZE, LANDMARK_INPUT_SIZE, 3])
+            self.interp_lm.allocate_tensors()
+            self.landmark_batch_size = 1
+            return [self.get_landmarks(img, hand, bgr) for hand in hands]
+
+        reg_batch = self.interp_lm.get_tensor(self.lm_reg_idx).reshape(num_hands, -1)
+        for hand, reg, Mtr in zip(hands, reg_batch, transforms):
+            hand['joints'] = self.project_landmarks(reg, Mtr)
+
+        if self.lm_flag_idx is not None:
+            confidences = self.interp_lm.get_tensor(self.lm_flag_idx).reshape(num_hands, -1)[:, 0]
+            for hand, confidence in zip(hands, confidences):
+                hand['confidence'] = float(confidence)
+
+        return hands
+
+    def project_landmarks(self, reg, Mtr):
+        """
+        projects the landmarks of a hand crop back onto the full-sized image using the affine transform of the crop
+        """
         if len(reg) == 63:
             reg = reg.reshape(-1, 3)
         else:
@@ -320,16 +477,19 @@ class HandLandmarkDetectionService:
         if len(reg[0]) == 3:
             kp_orig = np.concatenate((kp_orig, reg[:, 2:3]), axis=1)
 
-        hand['joints'] = kp_orig
-        return hand
+        return kp_orig
 
-    def __call__(self, img, hands=None):
+    def __call__(self, img, hands=None, bgr=False, gate_movement=True):
         r"""
         Method used to detect hand poses in individual images
         and track hands in video frames.
         Args:
             img: image as a numpy array of shape (h,w,3)
             hands: detected hands from previous time step
+            bgr: True if the image is in BGR order (e.g. from OpenCV). It is
+                 converted to RGB while cropping, without copying the full image
+            gate_movement: Ignore detections of hands that moved further than
+                           their size (see track())
         Output:
             hands: ordered list of dictionaries containing
                 'bbox': bounding box of a hand
@@ -337,10 +497,10 @@ class HandLandmarkDetectionService:
             During normal operation hand ordering is preserved
             between video frames
         """
-        img_pad, img_norm, pad = self.preprocess_img(img)
-        scale = img_pad.shape[0] / img_norm.shape[0]
-
         if hands is None:
+            # The palm detection input is only needed if the hands are not known from the previous frame
+            img_norm, scale, pad = self.preprocess_img(img, bgr)
+
             try:
                 hands = self.detect_hand(img_norm, scale=scale)
             except:
@@ -348,16 +508,75 @@ class HandLandmarkDetectionService:
             for rec in hands:
                 rec['lm'] -= pad[::-1]
 
-            tracked = self.track(hands)
+            tracked = self.track(hands, gate_movement)
 
             hands = [{'lm': x, 'size': y, 'dydx': z} for x, y, z in zip(
                 tracked[0], tracked[1], tracked[2])]
 
         hands = [self.add_bbox(h) for h in hands]
-        hands = [self.get_landmarks(img, h) for h in hands]
+        if self.batched_landmark_detection:
+            hands = self.get_landmarks_batch(img, hands, bgr)
+        else:
+            hands = [self.get_landmarks(img, h, bgr) for h in hands]
 
         return hands
 
+    def detect_and_track(self, img, bgr=False):
+        """
+        Detect hands in the first frame and track them in the following frames like MediaPipe does: The landmarks of
+        each hand in the previous frame define the crop for the landmark model in the current frame. The palm detection
+        only runs again if no hands are tracked, if the landmark model lost confidence in a tracked hand or after
+        DETECTION_INTERVAL frames, e.g. to find hands that newly entered the image.
+        Args:
+            img: image as a numpy array of shape (h,w,3)
+            bgr: True if the image is in BGR order
+        Output:
+            hands: list of dictionaries like returned by __call__
+        """
+        self.frames_since_detection += 1
+        run_detection = (len(self.tracked_hands) == 0 or self.hand_lost or
+                         self.frames_since_detection >= DETECTION_INTERVAL)
+
+        if run_detection:
+            # Without a hand presence score, hands that left the image can not be told apart from tracked ones. Start
+            # over with the new detections to avoid ghost hands
+            if self.lm_flag_idx is None:
+                self.reset()
+
+            # The hands were tracked since the last detection, so they can have moved a lot since then. Take over the
+            # new detections in any case
+            hands = self(img, bgr=bgr, gate_movement=False)
+            self.frames_since_detection = 0
+        else:
+            hands = self(img, hands=self.tracked_hands, bgr=bgr)
+            # The size of a tracked hand follows its landmarks, e.g. when it moves closer to the camera
+            for hand in hands:
+                hand['size'] = self.get_size_from_joints(hand['joints'])
+
+        self.tracked_hands = self.remove_lost_hands(hands)
+
+        return self.tracked_hands
+
+    def remove_lost_hands(self, hands):
+        """
+        Stops tracking hands the landmark model has lost confidence in, e.g. because they left the image. Otherwise
+        they would be kept in the tracking data and moved on by their momentum
+        """
+        keep = np.array([hand.get('confidence', 1) >= MIN_TRACKING_CONFIDENCE for hand in hands], dtype=bool)
+        self.hand_lost = not np.all(keep)
+
+        if self.hand_lost and len(keep) == len(self.hands):
+            self.hands = self.hands[keep]
+            self.sizes = self.sizes[keep]
+            self.dydx = self.dydx[keep]
+
+        return [hand for hand, keep_hand in zip(hands, keep) if keep_hand]
+
+    @staticmethod
+    def get_size_from_joints(joints):
+        extent = joints.max(axis=0) - joints.min(axis=0)
+        return np.array([extent.max() * TRACKING_BOX_ENLARGE])
+
     # Draw circles on the frame for all detected coordinates of the hand
     def add_hand_tracking_points(self, frame, detected_hands):
         # print("Num Hands here:", len(detected_hands))
@@ -12,11 +12,15 @@ DEBUG_MODE = True
 class ObjectDetectionService:
 
     def __init__(self):
+        # Debug images of the last detection. The caller shows them in the main thread
+        self.debug_images = {}
+
         print('[ObjectDetectionService]: Ready')
 
     def detect_objects_basic(self, frame, mask):
 
         detected_objects = []
+        self.debug_images = {}
 
         print(frame.shape)
 
@@ -26,7 +30,7 @@ class ObjectDetectionService:
 
         if DEBUG_MODE:
             output_image = draw_bbox(frame, bbox, label, conf)
-            cv2.imshow('all objects', output_image)
+            self.debug_images['all objects'] = output_image
 
         # for i in range(len(bbox)):
         #     detected_objects.append({
@@ -48,6 +52,7 @@ class ObjectDetectionService:
     def detect_generic_objects(self, frame, mask):
 
         detected_objects = []
+        self.debug_images = {}
 
         extracted_objects = self.extract_objects(frame, mask)
 
@@ -75,7 +80,7 @@ class ObjectDetectionService:
                 cv2.putText(img=frame, text=str(label), org=(int(extracted_object['x']), int(extracted_object['y'])),
                             fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=2, color=(0, 0, 0))
 
-        cv2.imshow('labels', frame)
+        self.debug_images['labels'] = frame
 
         return detected_objects
 
@@ -106,7 +111,7 @@ class ObjectDetectionService:
         kernel = np.ones((9, 9), np.uint8)
         foreground_mask = cv2.erode(foreground_mask, kernel, iterations=4)
         #mask = cv2.dilate(mask, kernel, iterations=3)
-        cv2.imshow('mask', foreground_mask)
+        self.debug_images['mask'] = foreground_mask
 
         contours, hierarchy = cv2.findContours(foreground_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -9,6 +9,13 @@ from ast import literal_eval as make_tuple  # Needed to convert strings stored i
 
 CONFIG_FILE_NAME = '../calibration/config.ini'
 
+# Use precomputed lookup maps instead of calculating the perspective transformation for each pixel on every frame
+USE_REMAP = True
+
+# Crop the camera frame to the table area before warping. Services then only need to process the table pixels
+ROI_MODE = False
+ROI_TARGET_RESOLUTION = None  # (width, height) of the extracted table area in ROI mode. None: Size of the table area
+
 
 class TableSurfaceExtractor:
 
@@ -18,6 +25,9 @@ class TableSurfaceExtractor:
     table_corner_bottom_right = (0, 0)
 
     def __init__(self):
+        self.perspective_transforms = {}
+        self.warp_maps = {}
+
         self.read_config_file()
 
     # In the config file, info like the table corner coordinates are stored
@@ -38,21 +48,102 @@ class TableSurfaceExtractor:
 
     # TODO: Check differences between camera and table aspect ratio
     # Based on: https://www.youtube.com/watch?v=PtCQH93GucA
-    def extract_table_area(self, frame):
+    def extract_table_area(self, frame, interpolation=cv2.INTER_LINEAR):
+        """ Warp the table area of the given frame to the output resolution (see get_output_resolution())
+
+            Parameters:
+                frame (np.ndarray): Camera frame
+                interpolation (int): OpenCV interpolation flag. Use cv2.INTER_NEAREST for depth frames, so that the
+                                     measured distances are not mixed up at object borders.
+        """
         x = frame.shape[1]
         y = frame.shape[0]
 
-        pts1 = np.float32([list(self.table_corner_top_left),
-                           list(self.table_corner_top_right),
-                           list(self.table_corner_bottom_left),
-                           list(self.table_corner_bottom_right)])
+        if ROI_MODE:
+            # Crop the frame to the bounding rectangle of the table before warping. This only creates a view
+            roi_x, roi_y, roi_width, roi_height = self.get_table_bounding_rect(x, y)
+            frame = frame[roi_y:roi_y + roi_height, roi_x:roi_x + roi_width]
+
+        if USE_REMAP:
+            map_1, map_2 = self.get_warp_maps(x, y, interpolation == cv2.INTER_NEAREST)
+            return cv2.remap(frame, map_1, map_2, interpolation)
+
+        matrix = self.get_perspective_transform(x, y)
+
+        return cv2.warpPerspective(frame, matrix, self.get_output_resolution(x, y), flags=interpolation)
+
+    def get_output_resolution(self, x, y):
+        """ Resolution of the frames returned by extract_table_area() for camera frames of the given resolution
+
+            Without ROI mode, this is the camera resolution. In ROI mode it is ROI_TARGET_RESOLUTION or, if not set,
+            the size of the bounding rectangle of the table.
+        """
+        if not ROI_MODE:
+            return x, y
+        if ROI_TARGET_RESOLUTION is not None:
+            return ROI_TARGET_RESOLUTION
+
+        _, _, roi_width, roi_height = self.get_table_bounding_rect(x, y)
+        return roi_width, roi_height
+
+    # Get the bounding rectangle (x, y, width, height) of the table corners, limited to the camera frame
+    def get_table_bounding_rect(self, x, y):
+        roi_x, roi_y, roi_width, roi_height = cv2.boundingRect(np.int32(self.get_table_corners()))
+
+        roi_x = min(max(roi_x, 0), x - 1)
+        roi_y = min(max(roi_y, 0), y - 1)
+        roi_width = min(roi_width, x - roi_x)
+        roi_height = min(roi_height, y - roi_y)
+
+        return roi_x, roi_y, roi_width, roi_height
+
+    # The perspective transform only depends on the frame size and the table corners, so it is cached
+    def get_perspective_transform(self, x, y):
+        key = (x, y, self.get_table_corners())
+        matrix = self.perspective_transforms.get(key)
+
+        if matrix is None:
+            pts1 = np.float32([list(self.table_corner_top_left),
+                               list(self.table_corner_top_right),
+                               list(self.table_corner_bottom_left),
+                               list(self.table_corner_bottom_right)])
+
+            if ROI_MODE:
+                # The corners need to be relative to the cropped frame
+                roi_x, roi_y, _, _ = self.get_table_bounding_rect(x, y)
+                pts1 -= np.float32([roi_x, roi_y])
+
+            output_x, output_y = self.get_output_resolution(x, y)
+            pts2 = np.float32([[0, 0], [output_x, 0], [0, output_y], [output_x, output_y]])
+            matrix = cv2.getPerspectiveTransform(pts1, pts2)
+            self.perspective_transforms[key] = matrix
+
+        return matrix
+
+    # Precompute for each pixel of the output frame where it comes from in the camera frame. The maps are stored in
+    # OpenCV's fixed-point format, which is the fastest input for cv2.remap()
+    def get_warp_maps(self, x, y, nearest_neighbour=False):
+        key = (x, y, self.get_table_corners(), nearest_neighbour)
+        maps = self.warp_maps.get(key)
+
+        if maps is None:
+            matrix = self.get_perspective_transform(x, y)
+
+            output_x, output_y = self.get_output_resolution(x, y)
+            grid_x, grid_y = np.meshgrid(np.arange(output_x, dtype=np.float32), np.arange(output_y, dtype=np.float32))
+            output_points = np.dstack((grid_x, grid_y))
+            source_points = cv2.perspectiveTransform(output_points, np.linalg.inv(matrix))
 
-        pts2 = np.float32([[0, 0], [x, 0], [0, y], [x, y]])
-        matrix = cv2.getPerspectiveTransform(pts1, pts2)
+            # For nearest neighbour interpolation, the coordinates are rounded and no interpolation table is needed
+            maps = cv2.convertMaps(source_points[:, :, 0], source_points[:, :, 1], cv2.CV_16SC2,
+                                   nninterpolation=nearest_neighbour)
+            self.warp_maps[key] = maps
 
-        frame = cv2.warpPerspective(frame, matrix, (x, y))
+        return maps
 
-        return frame
+    def get_table_corners(self):
+        return (self.table_corner_top_left, self.table_corner_top_right, self.table_corner_bottom_left,
+                self.table_corner_bottom_right)
 
     def get_table_border(self):
         table_border = np.array([self.table_corner_top_left, self.table_corner_top_right,
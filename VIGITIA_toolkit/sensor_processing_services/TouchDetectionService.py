@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import time
+
 import numpy as np
 import cv2
 import imutils
@@ -16,6 +19,23 @@ MAX_DIST_TOUCH = 50  # mm
 MIN_FINGER_DISTANCE_FROM_TABLE_BORDER = 20  # Ignore touch points closer than X pixels to table border
 
 NUM_FRAMES_FOR_BACKGROUND_MODEL = 50
+# If True, the background model is built incrementally from each frame. Otherwise all frames are stored first.
+BACKGROUND_MODEL_STREAMING = True
+
+# The background model is stored together with the orientation of the depth images. It is learned again if the stored
+# model does not match (e.g. after FLIP_IMAGE has been changed in the VIGITIASensorProcessingController)
+BACKGROUND_MODEL_FILE = 'background_model.npz'
+BACKGROUND_MODEL_VERSION = 2
+OUTDATED_BACKGROUND_MODEL_FILES = ['background_average.npy', 'background_standard_deviation.npy']
+
+# Keep adapting the background model during runtime to compensate for sensor drift (e.g. while the table warms up).
+# The drift happens over hours, so the model adapts slowly: Time constant of the exponential moving average in seconds
+ADAPTIVE_BACKGROUND_MODEL = True
+BACKGROUND_ADAPTATION_TIME_CONSTANT = 30 * 60
+# Maximum difference (in mm) between a depth value and the background model that is blended in. Objects that are not
+# part of the foreground mask are only absorbed into the background very slowly
+MAX_BACKGROUND_ADAPTATION_DIFFERENCE = 5
+ARM_MASK_DILATION_PX = 15  # Also skip pixels close to arms when adapting the background model
 
 COLOR_TOUCH = [113, 204, 46]
 COLOR_HOVER = [18, 156, 243]
@@ -64,6 +84,8 @@ class TouchDetectionService:
     num_frame = 0
 
     stored_background_values = None
+    background_running_mean = None
+    background_running_m2 = None
     background_average = None
     background_standard_deviation = None
     background_model_available = False
@@ -75,30 +97,50 @@ class TouchDetectionService:
 
     highest_touch_id = 1  # Keep track of the currently highest present ID
 
-    def __init__(self):
+    last_background_update_time = None
+
+    def __init__(self, image_flipped=False):
+        """
+        Parameters:
+            image_flipped (bool): True if the depth images are rotated by 180 degrees (see FLIP_IMAGE in the
+                                  VIGITIASensorProcessingController). Stored with the background model
+        """
+        self.image_flipped = image_flipped
         self.init_background_model()
         self.foreground_mask_extractor = ForegroundMaskExtractor()
 
+        # Debug images of the last call of get_touch_points(). OpenCV windows may only be used in the main thread, so
+        # they are shown by the caller
+        self.debug_images = {}
+
         print('[TouchDetectionService]: Ready')
 
-    # TODO: Generate backround model during runtime of the last X frames
     def init_background_model(self):
-        background_temp = None
-        deviation_temp = None
+        for file_name in OUTDATED_BACKGROUND_MODEL_FILES:
+            if os.path.isfile(file_name):
+                print('[TouchDetectionService]: Ignoring background model of an older version:', file_name)
+
         try:
-            background_temp = np.load('background_average.npy')
-            deviation_temp = np.load('background_standard_deviation.npy')
+            with np.load(BACKGROUND_MODEL_FILE) as stored_model:
+                stored_model = {key: stored_model[key] for key in stored_model.files}
         except FileNotFoundError:
             print("[TouchDetectionService]: No stored background")
+            return
+
+        if stored_model['version'] != BACKGROUND_MODEL_VERSION or stored_model['image_flipped'] != self.image_flipped:
+            print('[TouchDetectionService]: Stored background model does not match the current settings. Creating a '
+                  'new one')
+            return
 
-        if background_temp is not None and deviation_temp is not None:
-            print('[TouchDetectionService]: Found stored background model')
-            self.background_average = background_temp
-            self.background_standard_deviation = deviation_temp
-            self.background_model_available = True
+        print('[TouchDetectionService]: Found stored background model')
+        self.background_average = stored_model['average']
+        self.background_standard_deviation = stored_model['standard_deviation']
+        self.background_model_available = True
 
     # Main function to request touch points in the image
     def get_touch_points(self, color_image, depth_image, hand_regions, detected_hands, foreground_mask):
+        self.debug_images = {}
+
         if self.table_border is None:
             self.table_border = np.array([(0, 0), (color_image.shape[1], 0),
                                           (color_image.shape[1], color_image.shape[0]), (0, color_image.shape[1])])
@@ -108,6 +150,13 @@ class TouchDetectionService:
         self.depth_res_x = depth_image.shape[1]
         self.depth_res_y = depth_image.shape[0]
 
+        # A stored background model can not be used for a different resolution
+        if self.background_model_available and self.background_average.shape != depth_image.shape:
+            print('[TouchDetectionService]: Resolution of the stored background model does not match. Creating a new '
+                  'one')
+            self.background_model_available = False
+            self.num_frame = 1
+
         # If we do not yet have a depth model of the background, a new one will be created
         if not self.background_model_available and self.num_frame <= NUM_FRAMES_FOR_BACKGROUND_MODEL:
             self.create_background_model(depth_image)
@@ -119,6 +168,9 @@ class TouchDetectionService:
 
         self.draw_touch_points(color_image, self.active_touch_points, hand_regions)
 
+        if ADAPTIVE_BACKGROUND_MODEL:
+            self.update_background_model(depth_image, foreground_mask)
+
         return self.active_touch_points
 
     def compare_with_cnn_points(self, new_touch_points, hand_regions, detected_hands):
@@ -172,40 +224,87 @@ class TouchDetectionService:
         pos = self.num_frame - 1
         print('[TouchDetectionService]: Storing frame ' + str(pos+1) + '/' + str(NUM_FRAMES_FOR_BACKGROUND_MODEL))
 
-        # TODO: Get dimensions from current frame
-        if self.stored_background_values is None:
-            self.stored_background_values = np.zeros(shape=(self.depth_res_y, self.depth_res_x, NUM_FRAMES_FOR_BACKGROUND_MODEL), dtype=np.int16)
-            self.background_average = np.zeros(shape=(self.depth_res_y, self.depth_res_x), dtype=np.int16)
-            self.background_standard_deviation = np.zeros(shape=(self.depth_res_y, self.depth_res_x), dtype=np.int16)
-
-        self.store_depth_values(depth_image, pos)
+        if BACKGROUND_MODEL_STREAMING:
+            self.accumulate_depth_values(depth_image, pos)
+        else:
+            self.store_depth_values(depth_image, pos)
 
         if pos == (NUM_FRAMES_FOR_BACKGROUND_MODEL - 1):
-            self.calculate_background_model_statistics(self.depth_res_x, self.depth_res_y)
+            self.calculate_background_model_statistics()
 
+    # Batched mode: Copy the whole frame into a preallocated stack of depth frames
     def store_depth_values(self, depth_image, pos):
-        for y in range(self.depth_res_y):
-            for x in range(self.depth_res_x):
-                current_depth_px = depth_image[y][x]
-                self.stored_background_values[y][x][pos] = current_depth_px
-
-    def calculate_background_model_statistics(self, depth_res_x, depth_res_y):
-        # TODO: Improve performance
-        for y in range(depth_res_y):
-            for x in range(depth_res_x):
-                stored_values_at_pixel = self.stored_background_values[y][x]
-                #stored_values_at_pixel = stored_values_at_pixel[stored_values_at_pixel != 0]
-                #if len(stored_values_at_pixel) == 0:
-                #    stored_values_at_pixel = [0]
-                # Calculate average depth value for all values stored for the specific pixel
-                self.background_average[y][x] = np.mean(stored_values_at_pixel)
-                # Implemented like in the paper "DIRECT"
-                self.background_standard_deviation[y][x] = 3 * np.std(stored_values_at_pixel)
+        if self.stored_background_values is None:
+            self.stored_background_values = np.zeros(shape=(NUM_FRAMES_FOR_BACKGROUND_MODEL, self.depth_res_y,
+                                                            self.depth_res_x), dtype=np.int16)
+
+        self.stored_background_values[pos] = depth_image
+
+    # Streaming mode: Update the running mean and sum of squared differences of each pixel (Welford's algorithm).
+    # Only two float arrays of the size of a single frame need to be kept in memory instead of the whole stack.
+    def accumulate_depth_values(self, depth_image, pos):
+        if self.background_running_mean is None:
+            self.background_running_mean = np.zeros(shape=(self.depth_res_y, self.depth_res_x), dtype=np.float32)
+            self.background_running_m2 = np.zeros(shape=(self.depth_res_y, self.depth_res_x), dtype=np.float32)
+
+        depth_values = depth_image.astype(np.float32)
+
+        delta = depth_values - self.background_running_mean
+        self.background_running_mean += delta / (pos + 1)
+        delta *= depth_values - self.background_running_mean
+        self.background_running_m2 += delta
+
+    def calculate_background_model_statistics(self):
+        if BACKGROUND_MODEL_STREAMING:
+            average = self.background_running_mean
+            standard_deviation = np.sqrt(self.background_running_m2 / NUM_FRAMES_FOR_BACKGROUND_MODEL)
+        else:
+            average = np.mean(self.stored_background_values, axis=0)
+            standard_deviation = np.std(self.stored_background_values, axis=0)
+
+        # Calculate average depth value for all values stored for the specific pixel
+        self.background_average = average.astype(np.int16)
+        # Implemented like in the paper "DIRECT"
+        self.background_standard_deviation = (3 * standard_deviation).astype(np.int16)
+        self.background_model_available = True
+
+        # Free the memory used for building the model
+        self.stored_background_values = None
+        self.background_running_mean = None
+        self.background_running_m2 = None
 
         # Write the background info to permanent storage.
         # If conditions dont change, it does not need to be created every time
-        np.save('background_average.npy', self.background_average)
-        np.save('background_standard_deviation.npy', self.background_standard_deviation)
+        np.savez(BACKGROUND_MODEL_FILE, average=self.background_average,
+                 standard_deviation=self.background_standard_deviation, version=BACKGROUND_MODEL_VERSION,
+                 image_flipped=self.image_flipped)
+
+    # Blend the current depth frame into the background model using an exponential moving average with a time constant
+    # of BACKGROUND_ADAPTATION_TIME_CONSTANT. The change of each pixel is limited, and pixels covered by arms (and pixels
+    # without valid depth data) are left untouched.
+    def update_background_model(self, depth_image, foreground_mask):
+        now = time.time()
+        if self.last_background_update_time is None:
+            self.last_background_update_time = now
+            return
+        adaptation_rate = 1 - np.exp(-(now - self.last_background_update_time) / BACKGROUND_ADAPTATION_TIME_CONSTANT)
+        self.last_background_update_time = now
+
+        if self.background_average.dtype != np.float32:
+            # The moving average needs sub-millimeter precision, otherwise small updates would be rounded away
+            self.background_average = self.background_average.astype(np.float32)
+            self.arm_mask_dilation_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (ARM_MASK_DILATION_PX,
+                                                                                       ARM_MASK_DILATION_PX))
+
+        # In the foreground mask, arms are black (see find_touch_points())
+        arm_mask = cv2.dilate(cv2.bitwise_not(foreground_mask), self.arm_mask_dilation_kernel)
+        update_mask = cv2.bitwise_not(arm_mask, mask=cv2.compare(depth_image, 0, cv2.CMP_GT))
+
+        difference = depth_image.astype(np.float32)
+        difference -= self.background_average
+        np.clip(difference, -MAX_BACKGROUND_ADAPTATION_DIFFERENCE, MAX_BACKGROUND_ADAPTATION_DIFFERENCE, out=difference)
+        difference *= adaptation_rate
+        np.add(self.background_average, difference, out=self.background_average, where=update_mask > 0)
 
     # Inspired by https://webnautes.tistory.com/m/1378
     def find_touch_points(self, color_image, depth_image, foreground_mask):
@@ -217,7 +316,7 @@ class TouchDetectionService:
         #foreground_mask = self.foreground_mask_extractor.get_foreground_mask_otsu(color_image)
         foreground_mask = cv2.bitwise_not(foreground_mask)
         #foreground_mask = self.foreground_mask_extractor.get_foreground_mask(color_image)
-        cv2.imshow('mask', foreground_mask)
+        self.debug_images['mask'] = foreground_mask
 
         #foreground_mask = self.remove_pixels_outside_table_border(foreground_mask)
 
@@ -275,7 +374,7 @@ class TouchDetectionService:
                     #
                     #     # TODO: Check if distance between points is realistic
 
-        cv2.imshow('Detected hands', black_image)
+        self.debug_images['Detected hands'] = black_image
 
         return touch_points
 
@@ -492,7 +591,7 @@ class TouchDetectionService:
                         org=touch_point.get_touch_coordinates(),
                         fontFace=cv2.FONT_HERSHEY_SIMPLEX, fontScale=2, color=(0, 0, 0))
 
-        cv2.imshow('touch points', color_image)
+        self.debug_images['touch points'] = color_image
 
     @staticmethod
     def get_touch_color(distance_to_table_mm):
@@ -17,6 +17,8 @@ FPS = 30
 
 class GenericWebcam(VIGITIACameraBase):
 
+    frame_notifications = True  # See VIGITIACameraBase.notify_new_frame()
+
     frame = None
 
     def __init__(self, ):
@@ -51,9 +53,14 @@ class GenericWebcam(VIGITIACameraBase):
             ret, frame = self.capture.read()
 
             if frame is not None:
-                with self.read_lock:
-                    self.frame = frame
-
+                # Store the frame together with its sequence number (see VIGITIACameraBase.borrow_frames())
+                with self.new_frame_condition:
+                    with self.read_lock:
+                        self.frame = frame
+                    self.notify_new_frame()
+
+    # Each frame is a new array, so it can be handed out without copying. This also makes it suitable for
+    # VIGITIACameraBase.borrow_frames()
     def get_frames(self):
         with self.read_lock:
             return self.frame, None
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+
+import numpy as np
+
+from VIGITIA_toolkit.core.VIGITIACameraBase import VIGITIACameraBase
+from VIGITIA_toolkit.core.VIGITIACameraRecorder import METADATA_FILE, CHUNK_FILE
+
+# Play the frames with the timing of the recording. Otherwise they are played as fast as they are processed: Each frame
+# is only replaced by the next one after it has been borrowed and released again, so no frame is skipped
+REPLAY_AT_RECORDED_SPEED = True
+LOOP_RECORDING = False  # Start again from the beginning at the end of the recording
+# Recording that is played if no other directory is given (relative to the working directory)
+REPLAY_DIRECTORY = 'recording'
+
+
+class ReplayCamera(VIGITIACameraBase):
+    """ Camera driver that plays back a recording of the VIGITIACameraRecorder
+
+        It can be used instead of a real camera, e.g. to tune and benchmark the sensor processing services
+        reproducibly without the hardware being attached.
+
+    """
+
+    frame_notifications = True  # See VIGITIACameraBase.notify_new_frame()
+
+    color_image = None
+    depth_image = None
+    sequence_number = 0
+
+    def __init__(self, recording_directory=REPLAY_DIRECTORY, at_recorded_speed=REPLAY_AT_RECORDED_SPEED,
+                 loop=LOOP_RECORDING):
+        self.recording_directory = recording_directory
+        self.at_recorded_speed = at_recorded_speed
+        self.loop = loop
+
+        self.metadata = self.load_metadata()
+
+        # The camera can also be created without a recording, e.g. when all available cameras are listed
+        if self.metadata is None:
+            super().__init__('Replay Camera')
+        else:
+            super().__init__('Replay of ' + self.metadata['camera_name'])
+
+            for stream in self.metadata['available_video_streams']:
+                self.add_video_stream(*stream)
+
+        self.started = False
+        self.read_lock = threading.Lock()
+        # Notified when a borrowed frame is given back. Needed when not playing at recorded speed
+        self.frame_released_condition = threading.Condition(self.read_lock)
+        self.released_sequence_number = 0
+
+    def load_metadata(self):
+        path = os.path.join(self.recording_directory, METADATA_FILE)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path) as file:
+            return json.load(file)
+
+    # Nothing to initialize apart from checking the recording. Only here to be interchangeable with the other cameras
+    def init_video_capture(self):
+        if self.metadata is None:
+            raise FileNotFoundError('[ReplayCamera]: No recording found in "{}"'.format(self.recording_directory))
+
+    def start(self):
+        if self.started:
+            print('[ReplayCamera]: Already running')
+            return None
+        else:
+            self.started = True
+            self.thread = threading.Thread(target=self.update, args=())
+            self.thread.start()
+            return self
+
+    def update(self):
+        while self.started:
+            self.play_recording()
+
+            if not self.loop:
+                print('[ReplayCamera]: End of recording')
+                break
+
+    def play_recording(self):
+        start_time = time.time()
+
+        for chunk_index in range(self.metadata['num_chunks']):
+            chunk = self.load_chunk(chunk_index)
+
+            for i in range(len(chunk['timestamps'])):
+                if not self.started:
+                    return
+
+                if self.at_recorded_speed:
+                    time_to_wait = start_time + chunk['timestamps'][i] - time.time()
+                    if time_to_wait > 0:
+                        time.sleep(time_to_wait)
+                else:
+                    self.wait_until_frame_consumed()
+
+                depth_image = chunk['depth'][i] if 'depth' in chunk else None
+                self.publish_frame(chunk['color'][i], depth_image)
+
+    def load_chunk(self, chunk_index):
+        with np.load(os.path.join(self.recording_directory, CHUNK_FILE.format(chunk_index))) as file:
+            chunk = {key: file[key] for key in file.files}
+
+        # The frames are handed out without copying. Consumers must not modify them
+        for key in ['color', 'depth']:
+            if key in chunk:
+                chunk[key].flags.writeable = False
+
+        return chunk
+
+    def publish_frame(self, color_image, depth_image):
+        with self.read_lock:
+            self.color_image = color_image
+            self.depth_image = depth_image
+            self.sequence_number += 1
+            sequence_number = self.sequence_number
+
+        self.notify_new_frame(sequence_number)
+
+    # Wait until the current frame has been borrowed and released again by a consumer
+    def wait_until_frame_consumed(self):
+        with self.frame_released_condition:
+            self.frame_released_condition.wait_for(
+                lambda: not self.started or self.released_sequence_number >= self.sequence_number)
+
+    def get_frames(self):
+        with self.read_lock:
+            color_image = None if self.color_image is None else self.color_image.copy()
+            depth_image = None if self.depth_image is None else self.depth_image.copy()
+            return color_image, depth_image
+
+    # The frames of the recording are never overwritten, so they can be handed out without copying
+    def borrow_frames(self):
+        with self.read_lock:
+            return self.sequence_number, self.color_image, self.depth_image
+
+    def release_frames(self, sequence_number):
+        with self.frame_released_condition:
+            self.released_sequence_number = max(self.released_sequence_number, sequence_number)
+            self.frame_released_condition.notify_all()
+
+    def get_resolution(self):
+        return tuple(self.metadata['resolution'])
+
+    def stop(self):
+        self.started = False
+        with self.frame_released_condition:
+            self.frame_released_condition.notify_all()
+        self.thread.join()
+
+
+# Play back a recording and print the number of frames per second
+def main():
+    import cv2
+
+    if len(sys.argv) < 2:
+        print('Usage: ReplayCamera.py <recording directory>')
+        sys.exit(1)
+
+    camera = ReplayCamera(sys.argv[1], at_recorded_speed=False)
+    camera.start()
+
+    num_frames = 0
+    start_time = time.time()
+    sequence_number = 0
+    while True:
+        sequence_number = camera.wait_for_next_frame(1, sequence_number)
+        if sequence_number is None:
+            break
+
+        sequence_number, color_image, depth_image = camera.borrow_frames()
+        cv2.imshow('replay', color_image)
+        camera.release_frames(sequence_number)
+        num_frames += 1
+
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    print('[ReplayCamera]: {} frames, {:.1f} FPS'.format(num_frames, num_frames / (time.time() - start_time)))
+    camera.stop()
+    sys.exit()
+
+
+if __name__ == '__main__':
+    main()
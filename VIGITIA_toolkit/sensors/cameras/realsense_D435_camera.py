@@ -14,6 +14,7 @@ import threading
 
 # Camera Settings
 from VIGITIA_toolkit.core.VIGITIACameraBase import VIGITIACameraBase
+from VIGITIA_toolkit.core.VIGITIAFrameRing import VIGITIAFrameRing
 
 DEPTH_RES_X = 1280
 DEPTH_RES_Y = 720
@@ -27,20 +28,24 @@ COLORIZER_MAX_DISTANCE = 1.5  # m
 
 NUM_FRAMES_WAIT_INITIALIZING = 100  # Let the camera warm up and let the auto white balance adjust
 
+# Number of preallocated buffers that new frames are written into. Consumers can borrow frames without copying them
+FRAME_RING_SIZE = 4
+
 DEBUG_MODE = False
 # TODO: Add Debug mode
 
 
 class RealsenseD435Camera(VIGITIACameraBase):
 
+    frame_notifications = True  # See VIGITIACameraBase.notify_new_frame()
+
     num_frame = 0
 
     pipeline = None
     align = None
     colorizer = None
 
-    color_image = None
-    depth_image = None
+    depth_colormap = None
 
     def __init__(self):
 
@@ -51,6 +56,11 @@ class RealsenseD435Camera(VIGITIACameraBase):
         self.add_video_stream('depth', 'z16', DEPTH_RES_X, DEPTH_RES_Y, DEPTH_FPS,
                               'Depth Stream of the Intel RealSense D435 camera. Each pixel corresponds to the measured '
                               'distance in mm.')
+        self.add_video_stream('depth_colorized', 'bgr8', DEPTH_RES_X, DEPTH_RES_Y, DEPTH_FPS,
+                              'Colorized depth stream of the Intel RealSense D435 camera, e.g. for previews. Only '
+                              'available if requested.', on_demand=True)
+
+        self.colorized_depth_lock = threading.Lock()
 
     def init_video_capture(self):
         try:
@@ -68,15 +78,16 @@ class RealsenseD435Camera(VIGITIACameraBase):
             # Start streaming
             profile = self.pipeline.start(config)
 
-            # Getting the depth sensor's depth scale (see rs-align example for explanation)
             depth_sensor = profile.get_device().first_depth_sensor()
-            self.depth_scale = depth_sensor.get_depth_scale()
-            # print("[RealSense D435]: Depth scale", self.depth_scale)
 
             # TODO: Allow settings to be changed on initializing the function
             depth_sensor.set_option(rs.option.laser_power, 360)  # 0 - 360
             depth_sensor.set_option(rs.option.depth_units, 0.001)  # Number of meters represented by a single depth unit
 
+            # Getting the depth sensor's depth scale (see rs-align example for explanation)
+            self.depth_scale = depth_sensor.get_depth_scale()
+            # print("[RealSense D435]: Depth scale", self.depth_scale)
+
             # Create an align object
             # rs.align allows us to perform alignment of depth frames to others frames
             # The "align_to" is the stream type to which we plan to align depth frames.
@@ -96,7 +107,7 @@ class RealsenseD435Camera(VIGITIACameraBase):
         self.init_colorizer()
 
         self.started = False
-        self.read_lock = threading.Lock()
+        self.frame_ring = VIGITIAFrameRing(FRAME_RING_SIZE, num_images=2)
 
     # The colorizer can colorize depth images
     def init_colorizer(self):
@@ -152,34 +163,59 @@ class RealsenseD435Camera(VIGITIACameraBase):
             # aligned_depth_frame = self.decimation_filter.process(aligned_depth_frame)
             # aligned_depth_frame = self.temporal_filter.process(aligned_depth_frame)
 
+            # These arrays point to memory of the RealSense SDK. They are only copied once, into the frame ring
             color_image = np.asanyarray(color_frame.get_data())
-            depth_image = np.array(aligned_depth_frame.get_data(), dtype=np.uint16)
+            depth_image = np.asanyarray(aligned_depth_frame.get_data())
             depth_image = self.get_depth_image_mm(depth_image)
-            depth_colormap = np.asanyarray(self.colorizer.colorize(aligned_depth_frame).get_data())
 
             # ir_left_frame = np.asanyarray(ir_left_frame.get_data())
             # ir_right_frame = np.asanyarray(ir_right_frame.get_data())
 
-            with self.read_lock:
-                self.color_image = color_image
-                self.depth_image = depth_image
+            sequence_number = self.frame_ring.write(color_image, depth_image)
+            if sequence_number is not None:
+                self.notify_new_frame(sequence_number)
+
+            # Colorizing the depth frame is a full pass over the frame, so only do it if anyone needs it
+            if self.is_video_stream_requested('depth_colorized'):
+                depth_colormap = np.array(self.colorizer.colorize(aligned_depth_frame).get_data())
+                with self.colorized_depth_lock:
+                    self.depth_colormap = depth_colormap
 
     # Convert the depth image into a numpy array where each pixel value corresponds to the measured distance in mm
-    # This conversion only works if the depth units are set to 0.001
+    # If the depth units are set to 0.001, the values already are in mm and the image is returned unchanged
     def get_depth_image_mm(self, depth_image):
-        depth_image_mm = depth_image.copy() * self.depth_scale * 1000
+        if round(self.depth_scale * 1000, 6) == 1:
+            return depth_image
+
+        depth_image_mm = depth_image * self.depth_scale * 1000
         depth_image_mm = np.array(depth_image_mm, dtype=np.uint16)
 
         return depth_image_mm
 
-    # Returns the requested camera frames
+    # Returns copies of the latest camera frames
     # TODO: Return only the frames that are requested via params
     def get_frames(self):
-        with self.read_lock:
-            if self.color_image is not None and self.depth_image is not None:
-                return self.color_image.copy(), self.depth_image.copy()
-            else:
-                return None, None
+        sequence_number, color_image, depth_image = self.frame_ring.borrow()
+        if sequence_number is None:
+            return None, None
+
+        color_image, depth_image = color_image.copy(), depth_image.copy()
+        self.frame_ring.release(sequence_number)
+
+        return color_image, depth_image
+
+    # Returns the latest colorized depth frame. Call request_video_stream('depth_colorized') first
+    def get_colorized_depth_image(self):
+        with self.colorized_depth_lock:
+            return self.depth_colormap
+
+    # Returns read-only views of the latest camera frames without copying them.
+    # The frames need to be given back with release_frames() as soon as they are no longer needed.
+    def borrow_frames(self):
+        return self.frame_ring.borrow()
+
+    def release_frames(self, sequence_number):
+        self.frame_ring.release(sequence_number)
 
     def get_resolution(self):
         return RGB_RES_X, RGB_RES_Y